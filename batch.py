@@ -0,0 +1,176 @@
+import argparse
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+from disk_image import IoThrottle
+from main import options_parser, process_image
+
+logger = logging.getLogger(__name__)
+
+PATH_DIGEST_LENGTH = 12
+WORKER_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+SUMMARY_TOTALS = ("files", "fragmented_files", "planned_moves", "files_moved", "clusters_moved", "bytes_moved")
+
+def read_manifest(manifest_path: Path) -> list[Path]:
+    """
+    Читает список образов: по одному пути в строке, пустые строки и строки с '#' пропускаются,
+    относительные пути отсчитываются от каталога манифеста
+    """
+    image_paths: list[Path] = []
+    with open(manifest_path, 'r', encoding='utf-8') as manifest_file:
+        for line in manifest_file:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            image_path = Path(line)
+            image_paths.append(image_path if image_path.is_absolute() else manifest_path.parent / image_path)
+    return image_paths
+
+def unique_images(image_paths: list[Path]) -> list[Path]:
+    """
+    Убирает повторы образов, сравнивая полные пути, чтобы один образ не обрабатывался двумя процессами
+    """
+    seen: set[Path] = set()
+    unique: list[Path] = []
+    for image_path in image_paths:
+        resolved = image_path.resolve()
+        if resolved not in seen:
+            seen.add(resolved)
+            unique.append(image_path)
+    return unique
+
+def image_options(args: argparse.Namespace, image_path: Path) -> argparse.Namespace:
+    """
+    Опции для одного образа: пути файлов прогресса, профиля, плана и снимка получают суффикс с именем образа
+    и хэшем его полного пути. Образы с одинаковыми именами из разных каталогов (vm1/disk.img, vm2/disk.img)
+    пишут в разные файлы, а путь снимка не меняется между запусками.
+    """
+    digest = hashlib.sha1(str(image_path.resolve()).encode('utf-8')).hexdigest()[:PATH_DIGEST_LENGTH]
+    options = argparse.Namespace(**vars(args))
+    for name in ("progress_json", "profile", "save_plan", "snapshot"):
+        value = getattr(options, name)
+        if value:
+            setattr(options, name, f"{value}.{image_path.name}-{digest}")
+    return options
+
+def run_image(image_path: Path, args: argparse.Namespace) -> dict:
+    """
+    Обрабатывает один образ в процессе пула. Любая ошибка превращается в запись со статусом failed,
+    чтобы сбой одного образа не прерывал остальные.
+    """
+    started = time.perf_counter()
+    try:
+        throttle = IoThrottle(args.max_bytes_per_second) if args.max_bytes_per_second else None
+        summary = process_image(image_path, image_options(args, image_path), throttle, print_report=False)
+        summary["status"] = "ok"
+    except Exception as error:
+        logger.error("Образ '%s' не обработан: %s", image_path, error)
+        summary = {
+            "image": str(image_path),
+            "status": "failed",
+            "error": f"{type(error).__name__}: {error}",
+            "traceback": traceback.format_exc(),
+        }
+    summary["seconds"] = time.perf_counter() - started
+    return summary
+
+def init_worker(log_level: str) -> None:
+    logging.basicConfig(level=log_level, format="[%(processName)s] %(message)s", force=True)
+
+def run_isolated(image_path: Path, args: argparse.Namespace) -> dict:
+    """
+    Обрабатывает образ в собственном короткоживущем процессе. Аварийное завершение процесса
+    (os._exit, сигнал, нехватка памяти) ломает только его пул и считается сбоем только этого образа.
+    Процесс запускается через forkserver (или spawn), а не fork: пулы создаются из потоков родителя,
+    и fork многопоточного процесса может унаследовать захваченные другими потоками блокировки.
+    """
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context(WORKER_START_METHOD),
+                             initializer=init_worker, initargs=(args.log_level,)) as executor:
+        try:
+            return executor.submit(run_image, image_path, args).result()
+        except BrokenProcessPool as error:
+            logger.error("Процесс обработки образа '%s' аварийно завершился", image_path)
+            return {"image": str(image_path), "status": "failed", "error": f"{type(error).__name__}: {error}",
+                    "seconds": time.perf_counter() - started}
+
+def run_batch(image_paths: list[Path], args: argparse.Namespace) -> dict:
+    """
+    Обрабатывает образы не более чем в args.workers процессах одновременно, по процессу на образ,
+    и собирает общий отчёт. Процессами управляют потоки родителя, которые только ждут результата.
+    """
+    started = time.perf_counter()
+    results: list[dict] = []
+    with ThreadPoolExecutor(max_workers=args.workers or os.cpu_count()) as executor:
+        futures = {executor.submit(run_isolated, image_path, args): image_path for image_path in image_paths}
+        for future in as_completed(futures):
+            try:
+                summary = future.result()
+            except Exception as error:
+                summary = {"image": str(futures[future]), "status": "failed",
+                           "error": f"{type(error).__name__}: {error}"}
+            logger.info("%s: %s", summary["image"], summary["status"])
+            results.append(summary)
+
+    order = {str(image_path): index for index, image_path in enumerate(image_paths)}
+    results.sort(key=lambda summary: order[summary["image"]])
+    totals = {name: sum(summary.get(name, 0) for summary in results) for name in SUMMARY_TOTALS}
+    return {
+        "images": len(results),
+        "succeeded": sum(1 for summary in results if summary["status"] == "ok"),
+        "failed": sum(1 for summary in results if summary["status"] != "ok"),
+        "seconds": time.perf_counter() - started,
+        "totals": totals,
+        "results": results,
+    }
+
+def print_batch_report(report: dict) -> None:
+    """
+    Выводит общий отчёт по пакету образов
+    """
+    for summary in report["results"]:
+        if summary["status"] == "ok":
+            print(f"{summary['image']}: файлов {summary.get('files', 0)}, фрагментированных "
+                  f"{summary.get('fragmented_files', 0)}, перемещено {summary.get('files_moved', 0)} "
+                  f"({summary.get('bytes_moved', 0)} байт) за {summary['seconds']:.1f} с")
+        else:
+            print(f"{summary['image']}: ошибка - {summary['error']}")
+    totals = report["totals"]
+    print(f"Образов: {report['images']}, успешно: {report['succeeded']}, с ошибкой: {report['failed']}")
+    print(f"Всего файлов: {totals['files']}, фрагментированных: {totals['fragmented_files']}, "
+          f"перемещено: {totals['files_moved']} ({totals['bytes_moved']} байт) за {report['seconds']:.1f} с")
+
+arg_parser = argparse.ArgumentParser(parents=[options_parser])
+arg_parser.add_argument("image_paths", type=str, nargs="*")
+arg_parser.add_argument("--manifest", type=str, default=None)
+arg_parser.add_argument("--workers", type=int, default=None)
+arg_parser.add_argument("--max-bytes-per-second", type=int, default=None)
+arg_parser.add_argument("--report", type=str, default=None)
+
+if __name__ == "__main__":
+    args = arg_parser.parse_args()
+    logging.basicConfig(level=args.log_level, format="%(message)s")
+    if args.plan:
+        arg_parser.error("--plan относится к одному образу и в пакетном режиме не поддерживается")
+    image_paths = [Path(image_path) for image_path in args.image_paths]
+    if args.manifest:
+        image_paths.extend(read_manifest(Path(args.manifest)))
+    image_paths = unique_images(image_paths)
+    if not image_paths:
+        arg_parser.error("не заданы образы: укажите пути или --manifest")
+
+    report = run_batch(image_paths, args)
+    print_batch_report(report)
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as report_file:
+            json.dump(report, report_file, ensure_ascii=False, indent=2)
+    if report["failed"]:
+        raise SystemExit(1)
@@ -0,0 +1,197 @@
+import argparse
+import contextlib
+import json
+import logging
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from bpb import BPB
+from defragmenter import Defragmenter
+from directory_parser import DirectoryParser
+from disk_image import DiskImage
+from fat_analysis import HAS_NUMPY, find_free_blocks, fragmentation_census
+from fat_reader import FAT_ENTRY_SIZE, FatReader
+from image_generator import ImageGenerator, ImageSpec, find_corrupted_files
+from planner import FILE_ORDER_TRAVERSAL, PLACEMENT_BEST_FIT, PLACEMENT_LOCALITY, LayoutPlanner, MovePlanner
+
+PHASES = ("fat_load", "census", "tree_scan", "planning", "relocation")
+MEGABYTE = 1024 * 1024
+
+def peak_rss() -> int | None:
+    """
+    Возвращает пиковый размер резидентной памяти процесса в байтах или None, если он недоступен
+    """
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+class Benchmark:
+    """
+    Замеряет по отдельности загрузку FAT, общую статистику FAT, обход дерева, планирование и перенос
+    данных на копии сгенерированного образа. Для каждой фазы сохраняются время, объём обработанных
+    кластеров и байтов, пропускная способность и пиковый RSS после фазы.
+    """
+    def __init__(self, image_path: Path, placement: str = PLACEMENT_BEST_FIT, verify: bool = True) -> None:
+        self.image_path = image_path
+        self.placement = placement
+        self.verify = verify
+
+    def run(self, work_path: Path) -> dict:
+        """
+        Выполняет один прогон на копии образа work_path
+        """
+        shutil.copyfile(self.image_path, work_path)
+        phases: dict[str, dict] = {}
+        with DiskImage(work_path) as image:
+            with self._phase(phases, "fat_load") as phase:
+                fat_reader = FatReader(image, BPB(image))
+            phase.update(clusters=fat_reader.total_clusters, bytes=len(fat_reader.fat) * FAT_ENTRY_SIZE)
+
+            with self._phase(phases, "census") as phase:
+                census = fragmentation_census(fat_reader.fat, fat_reader.total_clusters)
+            phase.update(clusters=fat_reader.total_clusters, bytes=len(fat_reader.fat) * FAT_ENTRY_SIZE, **census)
+
+            directory_parser = DirectoryParser(fat_reader)
+            with self._phase(phases, "tree_scan") as phase:
+                all_files, all_directories = directory_parser.get_tree(fat_reader.bpb.root_clus)
+            directory_clusters = sum(len(fat_reader.get_cluster_chain(directory["starting_cluster"]))
+                                     for directory in all_directories)
+            phase.update(clusters=directory_clusters, bytes=directory_clusters * fat_reader.cluster_size,
+                         files=len(all_files), directories=len(all_directories))
+
+            with self._phase(phases, "planning") as phase:
+                free_blocks = find_free_blocks(fat_reader.fat, fat_reader.total_clusters)
+                if self.placement == PLACEMENT_LOCALITY:
+                    plan = LayoutPlanner(fat_reader, free_blocks, FILE_ORDER_TRAVERSAL).plan(all_files, all_directories)
+                else:
+                    plan = MovePlanner(fat_reader, free_blocks).plan(all_files, all_directories)
+            phase.update(clusters=plan.clusters_to_move, bytes=plan.bytes_to_move, moves=len(plan.moves),
+                         fragmented_files=plan.fragmented_files)
+
+            defragmenter = Defragmenter(image, fat_reader, directory_parser)
+            with self._phase(phases, "relocation") as phase:
+                defragmenter.defragment(plan)
+            phase.update(clusters=plan.clusters_to_move, bytes=plan.bytes_to_move)
+
+            corrupted_files = find_corrupted_files(fat_reader, directory_parser) if self.verify else []
+
+        for phase in phases.values():
+            seconds = phase["seconds"]
+            phase["clusters_per_second"] = phase["clusters"] / seconds if seconds else None
+            phase["mb_per_second"] = phase["bytes"] / MEGABYTE / seconds if seconds else None
+        return {"phases": phases, "peak_rss": peak_rss(), "corrupted_files": corrupted_files}
+
+    @contextlib.contextmanager
+    def _phase(self, phases: dict[str, dict], name: str):
+        phase: dict = {}
+        started = time.perf_counter()
+        yield phase
+        phase["seconds"] = time.perf_counter() - started
+        phase["peak_rss"] = peak_rss()
+        phases[name] = phase
+
+def summarize(runs: list[dict]) -> dict:
+    """
+    Сводка по прогонам: минимальное и медианное время каждой фазы и пропускная способность по медиане
+    """
+    summary: dict[str, dict] = {}
+    for name in PHASES:
+        seconds = [run["phases"][name]["seconds"] for run in runs]
+        median = statistics.median(seconds)
+        first = runs[0]["phases"][name]
+        summary[name] = {
+            "min_seconds": min(seconds),
+            "median_seconds": median,
+            "clusters_per_second": first["clusters"] / median if median else None,
+            "mb_per_second": first["bytes"] / MEGABYTE / median if median else None,
+        }
+    return summary
+
+def compare(summary: dict, baseline: dict) -> dict:
+    """
+    Отношение медианного времени каждой фазы к базовому прогону: больше 1 - медленнее базы
+    """
+    ratios: dict[str, float | None] = {}
+    for name in PHASES:
+        base_seconds = baseline.get("summary", {}).get(name, {}).get("median_seconds")
+        ratios[name] = summary[name]["median_seconds"] / base_seconds if base_seconds else None
+    return ratios
+
+arg_parser = argparse.ArgumentParser()
+arg_parser.add_argument("--image", type=str, default=None)
+arg_parser.add_argument("--volume-size", type=int, default=ImageSpec.volume_size)
+arg_parser.add_argument("--cluster-size", type=int, default=ImageSpec.cluster_size)
+arg_parser.add_argument("--files", type=int, default=ImageSpec.files)
+arg_parser.add_argument("--directories", type=int, default=ImageSpec.directories)
+arg_parser.add_argument("--max-depth", type=int, default=ImageSpec.max_depth)
+arg_parser.add_argument("--lfn-density", type=float, default=ImageSpec.lfn_density)
+arg_parser.add_argument("--fragmentation", type=float, default=ImageSpec.fragmentation)
+arg_parser.add_argument("--max-file-clusters", type=int, default=ImageSpec.max_file_clusters)
+arg_parser.add_argument("--seed", type=int, default=ImageSpec.seed)
+arg_parser.add_argument("--placement", choices=[PLACEMENT_BEST_FIT, PLACEMENT_LOCALITY], default=PLACEMENT_BEST_FIT)
+arg_parser.add_argument("--repeat", type=int, default=3)
+arg_parser.add_argument("--no-verify", action="store_true")
+arg_parser.add_argument("--baseline", type=str, default=None)
+arg_parser.add_argument("--output", type=str, default=None)
+
+if __name__ == "__main__":
+    args = arg_parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
+    spec = ImageSpec(
+        volume_size=args.volume_size,
+        cluster_size=args.cluster_size,
+        files=args.files,
+        directories=args.directories,
+        max_depth=args.max_depth,
+        lfn_density=args.lfn_density,
+        fragmentation=args.fragmentation,
+        max_file_clusters=args.max_file_clusters,
+        seed=args.seed,
+    )
+
+    with tempfile.TemporaryDirectory() as work_directory:
+        if args.image:
+            image_path = Path(args.image)
+            image_summary = None
+        else:
+            image_path = Path(work_directory) / "benchmark.img"
+            image_summary = ImageGenerator(spec).generate(image_path)
+
+        benchmark = Benchmark(image_path, args.placement, not args.no_verify)
+        runs = [benchmark.run(Path(work_directory) / "work.img") for _ in range(args.repeat)]
+
+    result = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "numpy": HAS_NUMPY,
+        "image": args.image,
+        "spec": None if args.image else vars(spec),
+        "image_summary": image_summary,
+        "placement": args.placement,
+        "runs": runs,
+        "summary": summarize(runs),
+        "peak_rss": peak_rss(),
+    }
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as baseline_file:
+            result["baseline_ratio"] = compare(result["summary"], json.load(baseline_file))
+
+    output = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            output_file.write(output)
+    else:
+        print(output)
+    if any(run["corrupted_files"] for run in runs):
+        sys.exit(1)
@@ -1,13 +1,19 @@
 import struct
-from pathlib import Path
+
+from disk_image import DiskImage
+
+FSINFO_LEAD_SIG = 0x41615252
+FSINFO_STRUC_SIG = 0x61417272
+FSINFO_UNKNOWN = 0xFFFFFFFF
+EXT_FLAGS_NO_MIRRORING = 0x80
+EXT_FLAGS_ACTIVE_FAT_MASK = 0x0F
 
 class BPB:
-    def __init__(self, image_path: Path) -> None:
+    def __init__(self, image: DiskImage) -> None:
         """
         Класс для чтения BPB
         """
-        with open(image_path, 'rb') as image_file:
-            first_sector = image_file.read(512)
+        first_sector = bytes(image.read(0, 512))
 
         self.byts_per_sec = struct.unpack("<H", first_sector[11:13])[0]
         self.sec_per_clus = struct.unpack("<B", first_sector[13:14])[0]
@@ -15,4 +21,40 @@ class BPB:
         self.num_fats = struct.unpack("<B", first_sector[16:17])[0]
         self.total_sec_32 = struct.unpack("<I", first_sector[32:36])[0]
         self.fat_size_32 = struct.unpack("<I", first_sector[36:40])[0]
+        self.ext_flags = struct.unpack("<H", first_sector[40:42])[0]
         self.root_clus = struct.unpack("<I", first_sector[44:48])[0]
+        self.fs_info_sec = struct.unpack("<H", first_sector[48:50])[0]
+        self.bk_boot_sec = struct.unpack("<H", first_sector[50:52])[0]
+
+    def active_fats(self) -> list[int]:
+        """
+        Возвращает номера копий FAT, которые нужно поддерживать: все копии при зеркалировании,
+        иначе только активную
+        """
+        if self.ext_flags & EXT_FLAGS_NO_MIRRORING:
+            return [self.ext_flags & EXT_FLAGS_ACTIVE_FAT_MASK]
+        return list(range(self.num_fats))
+
+    def write_fs_info(self, image: DiskImage, free_count: int, next_free: int) -> bool:
+        """
+        Обновляет число свободных кластеров и подсказку следующего свободного кластера в секторе FSInfo.
+        Возвращает False, если сектор FSInfo отсутствует или повреждён.
+        """
+        if self.fs_info_sec in (0, 0xFFFF):
+            return False
+        fs_info_offset = self.fs_info_sec * self.byts_per_sec
+        lead_sig = struct.unpack("<I", image.read(fs_info_offset, 4))[0]
+        struc_sig = struct.unpack("<I", image.read(fs_info_offset + 484, 4))[0]
+        if lead_sig != FSINFO_LEAD_SIG or struc_sig != FSINFO_STRUC_SIG:
+            return False
+        image.write(fs_info_offset + 488, struct.pack("<II", free_count, next_free))
+        return True
+
+    def write_root_cluster(self, image: DiskImage, root_clus: int) -> None:
+        """
+        Записывает новый первый кластер корневого каталога в загрузочный сектор и его резервную копию
+        """
+        self.root_clus = root_clus
+        image.write(44, struct.pack("<I", root_clus))
+        if self.bk_boot_sec:
+            image.write(self.bk_boot_sec * self.byts_per_sec + 44, struct.pack("<I", root_clus))
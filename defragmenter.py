@@ -1,165 +1,383 @@
-import struct
+import logging
 from pathlib import Path
 
-from cluster import Cluster
+from bpb import FSINFO_UNKNOWN
+from disk_image import DiskImage
 from directory_parser import DirectoryParser
+from fat_analysis import count_fragments, find_free_blocks, fragmentation_census, free_extent_histogram
 from fat_reader import FatReader
+from free_space import FreeExtent, FreeExtentIndex
+from journal import STATE_COPIED, RelocationJournal
+from planner import FILE_ORDER_TRAVERSAL, PLACEMENT_BEST_FIT, PLACEMENT_LOCALITY, LayoutPlanner, MovePlan, MovePlanner, PlannedMove
+from progress import ProgressTracker
+from snapshot import VolumeSnapshot
+
+logger = logging.getLogger(__name__)
 
 FAT_END_MASK = 0x0FFFFFF8
 FAT_ENTRY_MASK = 0x0FFFFFFF
 FAT_FREE_MASK = 0x00000000
 
-ClusterIndexList = list[int]
+DEFAULT_COPY_BUFFER_SIZE = 8 * 1024 * 1024
+
+Extent = tuple[int, int, int]
 
 class Defragmenter:
     """
     Класс для дефрагментации файловой системы FAT32.
     """
-    def __init__(self, image_path: Path, fat_reader: FatReader, directory_parser: DirectoryParser) -> None:
-        self._image_path = image_path
+    def __init__(self, image: DiskImage, fat_reader: FatReader, directory_parser: DirectoryParser,
+                 copy_buffer_size: int = DEFAULT_COPY_BUFFER_SIZE, journal: RelocationJournal | None = None,
+                 defragment_directories: bool = True, compact_directories: bool = False,
+                 placement: str = PLACEMENT_BEST_FIT, file_order: str = FILE_ORDER_TRAVERSAL,
+                 progress: ProgressTracker | None = None, snapshot_path: Path | None = None) -> None:
+        self._image = image
+        self._copy_buffer_size = max(copy_buffer_size, fat_reader.cluster_size)
         self._fat_reader = fat_reader
         self._directory_parser = directory_parser
         self._bpb = fat_reader.bpb
-        self._free_clusters: list[int] = self._find_free_clusters()
+        self._journal = journal
+        self._defragment_directories = defragment_directories
+        self._compact_directories = compact_directories
+        self._placement = placement
+        self._file_order = file_order
+        self._progress = progress if progress is not None else ProgressTracker()
+        self._snapshot_path = snapshot_path
+        self._snapshot: VolumeSnapshot | None = None
+        self._directory_origins: dict[int, int] = {}
+        self._written_clusters: list[FreeExtent] = []
+        if self._journal is not None:
+            self._recover()
+        if self._snapshot_path is not None:
+            self._load_snapshot()
+        self._free_space = FreeExtentIndex(self._find_free_blocks())
 
-    def defragment(self) -> None:
+    def defragment(self, plan: MovePlan | None = None) -> None:
         """
-        Основной метод для дефрагментации файловой системы.
+        Основной метод для дефрагментации файловой системы: строит план перемещений
+        (если он не передан) и выполняет его.
         """
-        all_files = self._directory_parser.get_all_files(self._bpb.root_clus)
+        if plan is None:
+            plan = self.plan()
 
-        for file in all_files:
-            cluster_chain = self._fat_reader.get_cluster_chain(file["starting_cluster"])
-            cluster_indices = [cluster.index for cluster in cluster_chain]
+        self._progress.start(len(plan.moves), plan.bytes_to_move)
+        with self._progress.phase("relocation"):
+            for move in plan.moves:
+                self._execute_move(move)
+        for path in plan.unplaceable_files:
+            logger.warning("Файл '%s': не удалось найти подходящий блок свободных кластеров.", path)
 
-            if self._is_fragmented(cluster_chain):
-                print(f"Файл '{file['path']}' фрагментирован {cluster_indices}. Перемещаем...")
+        self._finish()
 
-                clusters_count = len(cluster_indices)
-                new_clusters_indices = self._allocate_clusters(clusters_count)
+    def defragment_streaming(self) -> None:
+        """
+        Дефрагментирует файлы по мере обхода дерева, не собирая список всех файлов и общий план:
+        каждый фрагментированный файл переносится сразу после чтения его записи. Каталоги в этом
+        режиме не переносятся, повторных попыток размещения нет.
+        """
+        planner = MovePlanner(self._fat_reader, self._find_free_blocks())
+        self._progress.start()
+        with self._progress.phase("relocation"):
+            for file in self._directory_parser.iter_files(self._bpb.root_clus):
+                cluster_chain = self._fat_reader.get_cluster_chain(file.starting_cluster)
+                fragments = count_fragments(cluster_chain)
+                if fragments <= 1:
+                    continue
+                move = planner.plan_file(file.path, file.entry_offset, cluster_chain, fragments)
+                if move is None:
+                    logger.warning("Файл '%s': не удалось найти подходящий блок свободных кластеров.", file.path)
+                    continue
+                self._execute_move(move)
 
-                for old, new in zip(cluster_indices, new_clusters_indices):
-                    self._copy_cluster_data(old, new)
+        self._finish()
 
-                self._update_fat(cluster_indices, new_clusters_indices)
-                self._update_directory_entry(file, new_clusters_indices[0])
+    def plan(self) -> MovePlan:
+        """
+        Строит план перемещений для всех файлов и каталогов без записи в образ. При сжатии каталогов
+        переносится и каждый нефрагментированный каталог с удалёнными записями: сжатые данные пишутся
+        в новые кластеры, а не поверх старых, чтобы прерванный прогон можно было откатить по журналу.
+        При размещении PLACEMENT_LOCALITY том упаковывается целиком в порядке обхода каталогов,
+        сжатие каталогов в этом режиме не выполняется.
+        """
+        with self._progress.phase("tree_scan"):
+            all_files, all_directories = self._directory_parser.get_tree(self._bpb.root_clus)
+        with self._progress.phase("planning"):
+            if self._placement == PLACEMENT_LOCALITY:
+                layout_planner = LayoutPlanner(self._fat_reader, self._find_free_blocks(), self._file_order,
+                                               self._defragment_directories)
+                return layout_planner.plan(all_files, all_directories)
+            if not self._defragment_directories:
+                all_directories = []
+            elif self._compact_directories:
+                for directory in all_directories:
+                    cluster_chain = self._fat_reader.get_cluster_chain(directory["starting_cluster"])
+                    compacted_size = len(self._directory_parser.compact_directory_data(cluster_chain))
+                    directory["compact"] = True
+                    directory["compacted_clusters"] = max(1, -(-compacted_size // self._fat_reader.cluster_size))
+                    directory["deleted_entries"] = self._directory_parser.count_deleted_entries(cluster_chain)
+            return MovePlanner(self._fat_reader, self._find_free_blocks()).plan(all_files, all_directories)
 
-                print(f"Файл '{file['path']}' перемещен в кластеры: {new_clusters_indices}")
+    def analyze(self, plan: MovePlan | None = None) -> dict:
+        """
+        Анализирует фрагментацию без записи в образ: считает фрагментированные файлы и фрагменты,
+        собирает общую статистику по FAT, строит гистограмму свободных экстентов и план перемещений.
+        """
+        if plan is None:
+            plan = self.plan()
+        free_blocks = self._find_free_blocks()
+        report = plan.to_dict()
+        report["free_clusters"] = self._free_space.free_clusters_count
+        report["census"] = fragmentation_census(self._fat_reader.fat, self._fat_reader.total_clusters, free_blocks)
+        report["free_extents_histogram"] = free_extent_histogram(free_blocks)
+        return report
 
-        self._write_fat()
-        print("Дефрагментация завершена успешно.")
+    def _execute_move(self, move: PlannedMove) -> None:
+        """
+        Выполняет одно перемещение из плана, предварительно сверяя его с текущим состоянием FAT
+        и записи каталога: сохранённый план мог устареть, например после переупорядочивания записей.
+        """
+        if self._read_starting_cluster(move.entry_offset) != move.old_start:
+            logger.warning("Запись каталога файла '%s' больше не указывает на кластер %d, пропускаем.",
+                           move.path, move.old_start)
+            return
+        cluster_indices = self._fat_reader.get_cluster_chain(move.old_start)
+        if len(cluster_indices) != move.clusters_count:
+            logger.warning("Файл '%s' изменился после построения плана, пропускаем.", move.path)
+            return
+
+        directory_data = None
+        if move.compact:
+            directory_data = self._directory_parser.compact_directory_data(cluster_indices)
+            if len(directory_data) > move.moved_clusters * self._fat_reader.cluster_size:
+                logger.warning("Каталог '%s' изменился после построения плана, пропускаем.", move.path)
+                return
+
+        try:
+            self._free_space.allocate(move.new_start, move.moved_clusters)
+        except ValueError:
+            logger.warning("Кластеры для файла '%s' уже заняты, пропускаем.", move.path)
+            return
 
-    def _is_fragmented(self, cluster_chain: list[Cluster]) -> bool:
+        logger.debug("Файл '%s' фрагментирован %s. Перемещаем...", move.path, cluster_indices)
+        new_clusters_indices = move.new_chain(cluster_indices)
+        self._relocate(move, cluster_indices, new_clusters_indices, directory_data)
+        if move.is_directory:
+            origin = self._directory_origins.pop(move.old_start, move.old_start)
+            self._directory_origins[new_clusters_indices[0]] = origin
+        self._progress.record_move(move.moved_clusters, move.bytes)
+        logger.debug("Файл '%s' перемещен в кластеры: %s", move.path, new_clusters_indices)
+
+    def _relocate(self, move: PlannedMove, old_clusters_indices: list[int], new_clusters_indices: list[int],
+                  directory_data: bytes | None = None) -> None:
         """
-        Проверяет, является ли кластерная цепочка фрагментированной.
+        Переносит данные файла или каталога в новые кластеры и перенаправляет на них FAT и запись
+        каталога. Для каталога также обновляются '.' и '..' подкаталогов, а при сжатии вместо копирования
+        записывается directory_data. При наличии журнала каждый шаг сначала фиксируется в нём,
+        а изменения FAT и каталога сбрасываются на диск до закрытия записи.
         """
-        for cluster_index in range(len(cluster_chain) - 1):
-            if cluster_chain[cluster_index].next_index != (cluster_chain[cluster_index].index + 1):
-                return True
-        return False
+        if self._journal is not None:
+            self._journal.begin(move.path, move.entry_offset, old_clusters_indices, new_clusters_indices,
+                                self._fat_reader.get_next_index(old_clusters_indices[-1]), move.is_directory)
+
+        if directory_data is not None:
+            capacity = len(new_clusters_indices) * self._fat_reader.cluster_size
+            self._image.write(self._fat_reader.get_cluster_offset(new_clusters_indices[0]),
+                              directory_data + bytes(capacity - len(directory_data)))
+        else:
+            for old_start, new_start, count in self._group_extents(old_clusters_indices, new_clusters_indices):
+                self._copy_extent(old_start, new_start, count)
 
-    def _find_free_clusters(self):
+        if self._journal is not None:
+            self._image.flush()
+            self._journal.mark_copied()
+
+        self._update_fat(old_clusters_indices, new_clusters_indices)
+        self._update_directory_entry(move, new_clusters_indices[0])
+        if move.is_directory:
+            self._directory_parser.update_dot_entries(new_clusters_indices[0], move.entry_offset is None)
+
+        if self._journal is not None:
+            self._fat_reader.flush_fat()
+            self._image.flush()
+            self._journal.commit()
+
+    def _recover(self) -> None:
         """
-        Находит все свободные кластеры.
+        Завершает или откатывает перемещение, прерванное в прошлом запуске. Если данные уже были
+        скопированы, FAT и запись каталога переводятся на новую цепочку, иначе восстанавливается старая.
         """
-        return [cluster.index for cluster in self._fat_reader.clusters if cluster.next_index == FAT_FREE_MASK]
+        record = self._journal.load()
+        if record is None:
+            return
+
+        old_clusters_indices, new_clusters_indices = record["old_chain"], record["new_chain"]
+        if record["state"] == STATE_COPIED:
+            logger.warning("Завершаем прерванное перемещение файла '%s'.", record["path"])
+            for cluster in old_clusters_indices:
+                self._fat_reader.set_next_index(cluster, FAT_FREE_MASK)
+            self._link_chain(new_clusters_indices, FAT_ENTRY_MASK)
+            start_cluster_index = new_clusters_indices[0]
+        else:
+            logger.warning("Откатываем прерванное перемещение файла '%s'.", record["path"])
+            for cluster in new_clusters_indices:
+                self._fat_reader.set_next_index(cluster, FAT_FREE_MASK)
+            self._link_chain(old_clusters_indices, record["old_chain_end"])
+            start_cluster_index = old_clusters_indices[0]
 
-    def _find_free_blocks(self) -> list[ClusterIndexList]:
+        self._write_starting_cluster(record["entry_offset"], start_cluster_index)
+        if record["is_directory"]:
+            self._directory_parser.update_dot_entries(start_cluster_index, record["entry_offset"] is None)
+        self._fat_reader.flush_fat()
+        self._image.flush()
+        self._journal.commit()
+
+    def _load_snapshot(self) -> None:
         """
-        Находит все непрерывные блоки свободных кластеров.
+        Загружает снимок прошлого прогона: неизменившиеся цепочки и каталоги берутся из него,
+        без снимка начинается пустой, который заполнится по ходу прогона. Кластеры, в которые
+        пишет прогон, запоминаются, чтобы при сохранении перечитать только задетые каталоги.
         """
-        free_sorted = sorted(self._free_clusters)
-        blocks: list[ClusterIndexList] = []
-        current_block: list[int] = []
+        snapshot = VolumeSnapshot.load(self._snapshot_path) if self._snapshot_path.exists() else None
+        self._snapshot = snapshot if snapshot is not None else VolumeSnapshot.empty(self._fat_reader)
+        self._snapshot.apply(self._fat_reader, self._directory_parser)
+        self._image.add_write_listener(self._record_written_clusters)
 
-        for cluster in free_sorted:
-            if not current_block:
-                current_block = [cluster]
-            elif cluster == current_block[-1] + 1:
-                current_block.append(cluster)
-            else:
-                blocks.append(current_block)
-                current_block = [cluster]
-        if current_block:
-            blocks.append(current_block)
+    def _record_written_clusters(self, offset: int, size: int) -> None:
+        """
+        Запоминает кластеры области данных, затронутые записью в образ
+        """
+        clusters = self._fat_reader.data_clusters(offset, size)
+        if clusters is not None:
+            self._written_clusters.append(clusters)
 
-        return blocks
+    def _finish(self) -> None:
+        """
+        Общее завершение прогона: сброс FAT, сохранение снимка и итоговая статистика
+        """
+        with self._progress.phase("fat_flush"):
+            self._write_fat()
+        self._save_snapshot()
+        self._progress.summary()
+        metadata_cache = self._fat_reader.metadata_cache
+        logger.info("Кэш метаданных каталогов: попаданий %d, промахов %d", metadata_cache.hits, metadata_cache.misses)
+        logger.info("Дефрагментация завершена успешно.")
 
-    def _find_best_fit_free_clusters(self, clusters_count: int) -> list[int]:
+    def _save_snapshot(self) -> None:
         """
-        Находит наиболее подходящий блок свободных кластеров (Best-Fit) для размещения файла.
+        Обновляет и сохраняет снимок тома после прогона: заново читаются только каталоги, в которые
+        писали или чьи цепочки изменились. Потоковый режим не заполняет кэш каталогов, поэтому дерево
+        обходится после переноса, и записанное в этом прогоне уже учтено обходом. Если снимок
+        не изменился, файл не перезаписывается.
         """
-        free_blocks = self._find_free_blocks()
-        best_fit = None
-        min_overflow = None
+        if self._snapshot is None:
+            return
+        with self._progress.phase("snapshot"):
+            relocated = {origin: cluster for cluster, origin in self._directory_origins.items()}
+            written_clusters = self._written_clusters
+            if not self._directory_parser.scanned_directories:
+                self._directory_parser.get_tree(self._bpb.root_clus)
+                relocated, written_clusters = {}, []
+            changed = self._snapshot.refresh(self._fat_reader, self._directory_parser, relocated, written_clusters)
+            if changed:
+                self._snapshot.save(self._snapshot_path)
+        self._directory_origins = {}
+        self._written_clusters = []
+        if changed:
+            logger.info("Снимок тома сохранён в %s", self._snapshot_path)
+        else:
+            logger.info("Снимок тома %s не изменился", self._snapshot_path)
 
-        for block in free_blocks:
-            if len(block) >= clusters_count:
-                overflow = len(block) - clusters_count
-                if (min_overflow is None) or (overflow < min_overflow):
-                    best_fit = block[:clusters_count]
-                    min_overflow = overflow
-                if overflow == 0:
-                    break  # Наилучший возможный вариант
-        if best_fit:
-            print(f"Best-Fit найден: {best_fit} с переполнением {min_overflow}")
-            return best_fit
-        raise Exception("Не удалось найти подходящий блок свободных кластеров.")
+    def _find_free_blocks(self) -> list[FreeExtent]:
+        """
+        Находит все непрерывные блоки свободных кластеров в виде (start, length).
+        """
+        return find_free_blocks(self._fat_reader.fat, self._fat_reader.total_clusters)
 
-    def _allocate_clusters(self, clusters_count: int) -> list[int]:
+    def _group_extents(self, old_clusters_indices: list[int], new_clusters_indices: list[int]) -> list[Extent]:
         """
-        Выделяет свободные кластеры для файла, используя алгоритм Best-Fit.
+        Разбивает перемещение на экстенты (old_start, new_start, count), в которых
+        и исходные, и новые кластеры идут подряд. Кластеры, остающиеся на месте, пропускаются.
         """
-        new_clusters = self._find_best_fit_free_clusters(clusters_count)
-        # Удаляем выделенные кластеры из списка свободных
-        for cluster in new_clusters:
-            self._free_clusters.remove(cluster)
-        return new_clusters
+        extents: list[Extent] = []
+        for old, new in zip(old_clusters_indices, new_clusters_indices):
+            if old == new:
+                continue
+            if extents:
+                old_start, new_start, count = extents[-1]
+                if old == old_start + count and new == new_start + count:
+                    extents[-1] = (old_start, new_start, count + 1)
+                    continue
+            extents.append((old, new, 1))
+        return extents
 
-    def _copy_cluster_data(self, old_cluster_index: int, new_cluster_index: int) -> None:
+    def _copy_extent(self, old_start_index: int, new_start_index: int, clusters_count: int) -> None:
         """
-        Копирует данные из одного кластера в другой
+        Копирует непрерывный экстент кластеров одной операцией
         """
-        with open(self._image_path, 'r+b') as f:
-            old_data = self._fat_reader.read_cluster_data(self._fat_reader.clusters[old_cluster_index])
-            f.seek(self._fat_reader.get_cluster_offset(new_cluster_index))
-            f.write(old_data)
+        self._image.copy(
+            self._fat_reader.get_cluster_offset(old_start_index),
+            self._fat_reader.get_cluster_offset(new_start_index),
+            clusters_count * self._fat_reader.cluster_size,
+            self._copy_buffer_size,
+        )
 
     def _update_fat(self, old_clusters_indices: list[int], new_clusters_indices: list[int]) -> None:
         """
         Обновляет FAT таблицу: освобождает старые кластеры и связывает новые кластеры.
+        Освобождённые кластеры сразу возвращаются в индекс свободного места.
         """
-        for cluster in old_clusters_indices:
-            self._fat_reader.clusters[cluster].next_index = FAT_FREE_MASK
+        released_clusters = set(old_clusters_indices).difference(new_clusters_indices)
+        for cluster in released_clusters:
+            self._fat_reader.set_next_index(cluster, FAT_FREE_MASK)
+        self._free_space.free_clusters(released_clusters)
 
-        for i in range(len(new_clusters_indices)):
-            current_cluster = new_clusters_indices[i]
-            if i < len(new_clusters_indices) - 1:
-                self._fat_reader.clusters[current_cluster].next_index = new_clusters_indices[i + 1]
+        self._link_chain(new_clusters_indices, FAT_ENTRY_MASK)
+        logger.debug("FAT таблица обновлена для новых кластеров: %s", new_clusters_indices)
+
+    def _link_chain(self, clusters_indices: list[int], end_value: int) -> None:
+        """
+        Связывает кластеры в цепочку в FAT, записывая end_value в последний кластер.
+        """
+        for i in range(len(clusters_indices)):
+            current_cluster = clusters_indices[i]
+            if i < len(clusters_indices) - 1:
+                self._fat_reader.set_next_index(current_cluster, clusters_indices[i + 1])
             else:
-                self._fat_reader.clusters[current_cluster].next_index = FAT_ENTRY_MASK
-        print(f"FAT таблица обновлена для новых кластеров: {new_clusters_indices}")
+                self._fat_reader.set_next_index(current_cluster, end_value)
 
-    def _update_directory_entry(self, file_entry: dict, new_start_cluster_index: int) -> None:
+    def _update_directory_entry(self, move: PlannedMove, new_start_cluster_index: int) -> None:
         """
-        Обновляет поле starting_cluster для файла в каталоге.
+        Обновляет поле starting_cluster для файла в каталоге по сохранённому смещению записи.
         """
-        self._directory_parser.update_starting_cluster(file_entry['path'], new_start_cluster_index)
+        self._write_starting_cluster(move.entry_offset, new_start_cluster_index)
+        logger.debug("Updated starting_cluster for '%s' to %d.", move.path, new_start_cluster_index)
 
-    def _write_fat(self) -> None:
+    def _read_starting_cluster(self, entry_offset: int | None) -> int | None:
         """
-        Записывает обновлённую FAT таблицу обратно в образ диска.
+        Читает первый кластер из записи каталога, а для корневого каталога (entry_offset = None) - из BPB.
         """
-        with open(self._image_path, 'r+b') as f:
-            fat_start = self._bpb.reserved_sec_cnt * self._bpb.byts_per_sec
-            fat_size = self._bpb.fat_size_32 * self._bpb.byts_per_sec
-            fat_data = bytearray()
+        if entry_offset is None:
+            return self._bpb.root_clus
+        return self._directory_parser.read_starting_cluster(entry_offset)
 
-            for cluster in self._fat_reader.clusters:
-                fat_entry = cluster.next_index & FAT_ENTRY_MASK
-                fat_data += struct.pack("<I", fat_entry)
+    def _write_starting_cluster(self, entry_offset: int | None, start_cluster_index: int) -> None:
+        """
+        Записывает первый кластер в запись каталога, а для корневого каталога (entry_offset = None) - в BPB.
+        """
+        if entry_offset is None:
+            self._bpb.write_root_cluster(self._image, start_cluster_index)
+        else:
+            self._directory_parser.write_starting_cluster(entry_offset, start_cluster_index)
 
-            f.seek(fat_start)
-            f.write(fat_data[:fat_size])
+    def _write_fat(self) -> None:
+        """
+        Записывает изменённые секторы FAT во все копии таблицы и обновляет FSInfo.
+        """
+        dirty_sectors_count = self._fat_reader.dirty_sectors_count
+        self._fat_reader.flush_fat()
+        next_free = self._free_space.first_free()
+        self._bpb.write_fs_info(self._image, self._free_space.free_clusters_count,
+                                FSINFO_UNKNOWN if next_free is None else next_free)
+        self._image.flush()
 
-        print("FAT таблицы обновлены.")
+        logger.info("FAT таблицы обновлены (секторов: %d).", dirty_sectors_count)
@@ -1,210 +1,348 @@
+import logging
 import struct
-from typing import Any
+import sys
+import zlib
+from collections.abc import Iterable, Iterator
+from operator import itemgetter
+from typing import Any, NamedTuple
 
 from fat_attributes import FatAttributes
-from fat_reader import FatReader
+from fat_reader import INT_OBJECT_SIZE, FatReader
+from free_space import FreeExtent, chain_to_runs
 
 ENTRY_SIZE = 32
 EMPTY_ENTRY_MARK = 0x00
 DELETED_ENTRY_MARK = 0xE5
 MIN_VALID_INDEX = 2
 
-class DirectoryParser:
+LONG_NAME_ATTRIBUTES = FatAttributes.LONG_NAME.value
+DIRECTORY_ATTRIBUTE = FatAttributes.DIRECTORY.value
+LFN_ENTRY_LAYOUT = "x10s3x12s2x4s"
+LFN_NAME_PADDING = "\uffff"
+DIRECTORY_ENTRY = struct.Struct("<11sB8xH4xHI")
+STARTING_CLUSTER_HALF = struct.Struct("<H")
+
+DirectoryItem = tuple[bool, dict[str, Any]]
+
+logger = logging.getLogger(__name__)
+
+class DirectoryEntry(NamedTuple):
     """
-    Класс для парсинга каталога
+    Разобранная короткая запись каталога с уже собранным длинным именем. buffer_index - номер
+    кластера в цепочке каталога, offset - смещение записи внутри этого кластера.
     """
-    def __init__(self, fat_reader: FatReader) -> None:
-        self.fat_reader = fat_reader
+    name: str
+    attributes: int
+    starting_cluster: int
+    size: int
+    buffer_index: int
+    offset: int
 
-    def parse_directory_entries(self, cluster_data: bytes) -> list[dict]:
-        entries: list[dict] = []
-        lfn_entries: list[str] = []
+DECODED_ENTRY_SIZE = (sys.getsizeof(DirectoryEntry("", 0, 0, 0, 0, 0)) + 3 * INT_OBJECT_SIZE
+                      + struct.calcsize("P"))
 
-        for i in range(0, len(cluster_data), ENTRY_SIZE):
-            entry = cluster_data[i:i + ENTRY_SIZE]
-            if entry[0] == EMPTY_ENTRY_MARK:
-                break
-            if entry[0] == DELETED_ENTRY_MARK:
-                continue
-
-            parsed_entry = self.parse_single_entry(entry, lfn_entries)
-            if parsed_entry is None:
-                continue
+def decoded_size(cluster_chain: list[int], entries: list[DirectoryEntry]) -> int:
+    """
+    Оценивает объём в памяти разобранного каталога: списки цепочки и записей, сами записи
+    с их числами и строки имён
+    """
+    return (sys.getsizeof(cluster_chain) + len(cluster_chain) * INT_OBJECT_SIZE + sys.getsizeof(entries)
+            + sum(DECODED_ENTRY_SIZE + sys.getsizeof(entry.name) for entry in entries))
 
-            full_name, attrs, starting_cluster, file_size = parsed_entry
-            if full_name in ('.', '..'):
-                lfn_entries = []
+def iter_directory_entries(buffers: Iterable[bytes | memoryview]) -> Iterator[DirectoryEntry]:
+    """
+    Общий декодер записей каталога: разбирает кластеры каталога подряд через DIRECTORY_ENTRY.iter_unpack,
+    пропускает удалённые записи и останавливается на первой пустой. LFN-записи не декодируются по одной:
+    запоминается начало их серии, и имя собирается одним проходом при встрече короткой записи.
+    Серия, начатая в предыдущем кластере, переносится через его границу.
+    """
+    carried_name = b""
+    for buffer_index, cluster_data in enumerate(buffers):
+        lfn_start = -1
+        index = -1
+        for index, (short_name, attributes, high, low, size) in enumerate(DIRECTORY_ENTRY.iter_unpack(cluster_data)):
+            first_byte = short_name[0]
+            if first_byte == EMPTY_ENTRY_MARK:
+                return
+            if first_byte == DELETED_ENTRY_MARK:
+                lfn_start = -1
+                carried_name = b""
                 continue
-            if starting_cluster < MIN_VALID_INDEX or starting_cluster >= len(self.fat_reader.clusters):
-                print(f"Предупреждение: Неверный начальный кластер {starting_cluster} для файла {full_name}")
-                lfn_entries = []
+            if attributes & LONG_NAME_ATTRIBUTES == LONG_NAME_ATTRIBUTES:
+                if lfn_start < 0:
+                    lfn_start = index
                 continue
 
-            entries.append({
-                "name": full_name,
-                "attributes": attrs,
-                "starting_cluster": starting_cluster,
-                "size": file_size
-            })
-            lfn_entries = []
-        return entries
-
-    def parse_single_entry(self, entry: bytes, lfn_entries: list[str]) -> tuple[str, FatAttributes, int, int] | None:
-        """
-        Разбор одной записи (32 байта). Возвращает кортеж (full_name, attrs, starting_cluster, file_size) или None,
-        если запись обрабатывать не нужно (например, LFN-части).
-        """
-        attrs = FatAttributes(entry[11])
-        if (attrs & FatAttributes.LONG_NAME) == FatAttributes.LONG_NAME:
-            lfn_part = self.parse_lfn_entry(entry)
-            lfn_entries.insert(0, lfn_part)
-            return None
-
-        if lfn_entries:
-            full_name = ''.join(c for c in ''.join(lfn_entries) if c.isprintable())
-        else:
-            name = entry[0:8].decode('ascii', errors='ignore').strip()
-            extension = entry[8:11].decode('ascii', errors='ignore').strip()
-            full_name = f"{name}.{extension}" if extension else name
+            if lfn_start >= 0 or carried_name:
+                long_name = carried_name
+                if lfn_start >= 0:
+                    long_name = _long_name_bytes(cluster_data, lfn_start, index) + long_name
+                name = long_name.decode('utf-16le', errors='ignore').partition('\x00')[0].rstrip(LFN_NAME_PADDING)
+                lfn_start = -1
+                carried_name = b""
+            else:
+                base = short_name[:8].decode('ascii', errors='ignore').strip()
+                extension = short_name[8:].decode('ascii', errors='ignore').strip()
+                name = f"{base}.{extension}" if extension else base
+            yield DirectoryEntry(name, attributes, (high << 16) | low, size, buffer_index, index * ENTRY_SIZE)
+
+        if lfn_start >= 0:
+            carried_name = _long_name_bytes(cluster_data, lfn_start, index + 1) + carried_name
+
+_lfn_layouts: dict[int, tuple[struct.Struct, itemgetter]] = {}
+
+def _long_name_bytes(cluster_data: bytes | memoryview, first_index: int, end_index: int) -> bytes:
+    """
+    Склеивает UTF-16 части имени из LFN-записей [first_index, end_index) одним unpack_from:
+    записи хранятся в обратном порядке, поэтому части переставляются готовым itemgetter
+    """
+    entries_count = end_index - first_index
+    layout = _lfn_layouts.get(entries_count)
+    if layout is None:
+        layout = (
+            struct.Struct("<" + LFN_ENTRY_LAYOUT * entries_count),
+            itemgetter(*(entry * 3 + part for entry in reversed(range(entries_count)) for part in range(3))),
+        )
+        _lfn_layouts[entries_count] = layout
+    lfn_struct, name_order = layout
+    return b"".join(name_order(lfn_struct.unpack_from(cluster_data, first_index * ENTRY_SIZE)))
+
+class FileRecord(NamedTuple):
+    """
+    Компактная запись о файле или каталоге для потокового обхода
+    """
+    path: str
+    starting_cluster: int
+    size: int
+    entry_offset: int
+    parent_cluster: int
 
-        high_bytes = entry[20:22]
-        low_bytes = entry[26:28]
-        high = struct.unpack("<H", high_bytes)[0]
-        low = struct.unpack("<H", low_bytes)[0]
-        starting_cluster = (high << 16) | low
-        file_size = struct.unpack("<I", entry[28:32])[0]
+class CachedDirectory(NamedTuple):
+    """
+    Разобранный каталог из прошлого обхода: путь, отрезки цепочки, CRC32 содержимого и элементы
+    """
+    path: str
+    runs: list[FreeExtent]
+    checksum: int
+    items: list[DirectoryItem]
 
-        return full_name, attrs, starting_cluster, file_size
+class DirectoryParser:
+    """
+    Класс для парсинга каталога
+    """
+    def __init__(self, fat_reader: FatReader) -> None:
+        self.fat_reader = fat_reader
+        self.directory_cache: dict[int, CachedDirectory] | None = None
+        self.scanned_directories: set[int] = set()
+        self.parsed_directories: set[int] = set()
 
-    def parse_lfn_entry(self, entry: bytes) -> str:
+    def _is_listed(self, entry: DirectoryEntry) -> bool:
+        """
+        Отбрасывает записи '.' и '..' и записи с недопустимым начальным кластером
+        """
+        if entry.name in ('.', '..'):
+            return False
+        if entry.starting_cluster < MIN_VALID_INDEX or entry.starting_cluster >= len(self.fat_reader.fat):
+            if entry.starting_cluster == 0 and entry.size == 0:
+                logger.debug("Пустой файл %s без кластеров", entry.name)
+            else:
+                logger.warning("Неверный начальный кластер %d для файла %s", entry.starting_cluster, entry.name)
+            return False
+        return True
+
+    def _iter_chain_entries(self, cluster_chain: list[int]) -> Iterator[DirectoryEntry]:
+        return iter_directory_entries(self.fat_reader.read_cluster_data(cluster) for cluster in cluster_chain)
+
+    def _directory_entries(self, dir_cluster_index: int) -> tuple[list[int], list[DirectoryEntry]]:
         """
-        Разбираем части длинного имени
+        Возвращает цепочку каталога и его разобранные записи. Результат хранится в кэше метаданных
+        FatReader, пока не изменятся кластеры каталога или их записи FAT; в бюджет кэша засчитывается
+        оценка объёма разобранных записей, а не размер кластеров на диске.
         """
-        name1 = entry[1:11].decode('utf-16le', errors='ignore').rstrip('\x00').rstrip('\xFF')
-        name2 = entry[14:26].decode('utf-16le', errors='ignore').rstrip('\x00').rstrip('\xFF')
-        name3 = entry[28:32].decode('utf-16le', errors='ignore').rstrip('\x00').rstrip('\xFF')
-        return name1 + name2 + name3
+        metadata_cache = self.fat_reader.metadata_cache
+        cached = metadata_cache.get(dir_cluster_index)
+        if cached is not None:
+            return cached
+        cluster_chain = self.fat_reader.get_cluster_chain(dir_cluster_index)
+        entries = list(self._iter_chain_entries(cluster_chain))
+        metadata_cache.put(dir_cluster_index, (cluster_chain, entries), cluster_chain,
+                           decoded_size(cluster_chain, entries))
+        return cluster_chain, entries
 
     def get_all_files(self, start_cluster_index: int) -> list[dict]:
         """
-        Получает список всех файлов в каталоге, начиная с заданного кластера.
+        Получает список всех файлов в каталоге, начиная с заданного кластера. Для каждого файла
+        запоминается абсолютное смещение его записи в образе и первый кластер родительского каталога.
         """
-        all_files: list[dict[str, Any]] = []
-
-        def traverse(cluster_index: int, path: str) -> None:
-            print(f"Обрабатываем каталог: {path if path else 'root'} (Кластер: {cluster_index})")
-            cluster_chain = self.fat_reader.get_cluster_chain(cluster_index)
-            for cluster_obj in cluster_chain:
-                cluster_data = self.fat_reader.read_cluster_data(cluster_obj)
-                entries = self.parse_directory_entries(cluster_data)
-
-                for entry in entries:
-                    file_path = f"{path}/{entry['name']}" if path else entry['name']
-                    print(f"Найдено: {file_path} (Атрибуты: {entry['attributes']})")
+        return self.get_tree(start_cluster_index)[0]
 
-                    if entry['name'] in ('.', '..'):
-                        continue
-
-                    if (entry["attributes"] & FatAttributes.DIRECTORY) and entry["starting_cluster"] != 0:
-                        traverse(entry["starting_cluster"], file_path)
-
-                    elif entry["starting_cluster"] != 0:
-                        all_files.append({
-                            "path": file_path,
-                            "starting_cluster": entry["starting_cluster"],
-                            "size": entry["size"]
-                        })
-
-        traverse(start_cluster_index, "")
-        return all_files
-
-    def find_directory_entry(self, dir_cluster_index: int, target_name: str) -> tuple[int, int] | None:
+    def get_tree(self, start_cluster_index: int) -> tuple[list[dict], list[dict]]:
         """
-        Ищет запись файла или каталога в заданном кластере. Возвращает смещение записи и индекс кластера,
-        в котором она найдена.
+        Обходит дерево и возвращает списки файлов и каталогов. Первым в списке каталогов идёт
+        сам стартовый каталог с entry_offset = None, остальные - в порядке обхода. Обход идёт в глубину
+        явным стеком, поэтому глубина дерева не ограничена глубиной рекурсии; каталог, уже встреченный
+        при обходе (цикл или перекрёстная ссылка), пропускается.
         """
-        cluster_chain = self.fat_reader.get_cluster_chain(dir_cluster_index)
-
+        all_files: list[dict[str, Any]] = []
+        all_directories: list[dict[str, Any]] = [self._root_record(start_cluster_index)]
+        visited: set[int] = {start_cluster_index}
+        stack = [iter(self.scan_directory(start_cluster_index, ""))]
+        while stack:
+            item = next(stack[-1], None)
+            if item is None:
+                stack.pop()
+                continue
+            is_directory, record = item
+            if not is_directory:
+                all_files.append(record)
+            elif record["starting_cluster"] in visited:
+                logger.warning("Цикл обнаружен в дереве каталогов: %s", record["path"])
+            else:
+                visited.add(record["starting_cluster"])
+                all_directories.append(record)
+                stack.append(iter(self.scan_directory(record["starting_cluster"], record["path"])))
+        return all_files, all_directories
+
+    def iter_files(self, start_cluster_index: int) -> Iterator[FileRecord]:
+        """
+        Лениво обходит дерево в том же порядке, что и get_tree, и выдаёт записи файлов по мере
+        чтения каталогов. В памяти держатся только стек открытых каталогов и номера уже пройденных
+        каталогов, поэтому расход памяти не зависит от числа файлов.
+        """
+        stack = [self._iter_directory(start_cluster_index, "")]
+        visited = {start_cluster_index}
+        while stack:
+            item = next(stack[-1], None)
+            if item is None:
+                stack.pop()
+                continue
+            is_directory, record = item
+            if not is_directory:
+                yield record
+            elif record.starting_cluster in visited:
+                logger.warning("Цикл обнаружен в дереве каталогов: %s", record.path)
+            else:
+                stack.append(self._iter_directory(record.starting_cluster, record.path))
+                visited.add(record.starting_cluster)
+
+    def _root_record(self, start_cluster_index: int) -> dict[str, Any]:
+        return {
+            "path": "",
+            "starting_cluster": start_cluster_index,
+            "size": 0,
+            "entry_offset": None,
+            "parent_cluster": None
+        }
+
+    def scan_directory(self, cluster_index: int, path: str) -> list[DirectoryItem]:
+        """
+        Читает один каталог и возвращает его элементы в порядке записей: пары (is_directory, record).
+        При включённом directory_cache каталог с прежними путём, цепочкой и CRC32 содержимого
+        не разбирается заново, а берётся из кэша; номера прочитанных и заново разобранных каталогов
+        запоминаются в scanned_directories и parsed_directories.
+        """
+        logger.debug("Обрабатываем каталог: %s (Кластер: %d)", path if path else "root", cluster_index)
+        if self.directory_cache is None:
+            return [(is_directory, record._asdict())
+                    for is_directory, record in self._iter_directory(cluster_index, path)]
+
+        self.scanned_directories.add(cluster_index)
+        runs = chain_to_runs(self.fat_reader.get_cluster_chain(cluster_index))
+        checksum = 0
+        for start, length in runs:
+            checksum = zlib.crc32(self.fat_reader.image.read(self.fat_reader.get_cluster_offset(start),
+                                                             length * self.fat_reader.cluster_size), checksum)
+        cached = self.directory_cache.get(cluster_index)
+        if cached is not None and cached.path == path and cached.runs == runs and cached.checksum == checksum:
+            return cached.items
+        items = [(is_directory, record._asdict()) for is_directory, record in self._iter_directory(cluster_index, path)]
+        self.directory_cache[cluster_index] = CachedDirectory(path, runs, checksum, items)
+        self.parsed_directories.add(cluster_index)
+        return items
+
+    def _iter_directory(self, cluster_index: int, path: str) -> Iterator[tuple[bool, FileRecord]]:
+        """
+        Выдаёт элементы одного каталога в порядке записей.
+        """
+        cluster_chain, entries = self._directory_entries(cluster_index)
+        for entry in entries:
+            if not self._is_listed(entry):
+                continue
+            yield bool(entry.attributes & DIRECTORY_ATTRIBUTE), FileRecord(
+                path=f"{path}/{entry.name}" if path else entry.name,
+                starting_cluster=entry.starting_cluster,
+                size=entry.size,
+                entry_offset=self.fat_reader.get_cluster_offset(cluster_chain[entry.buffer_index]) + entry.offset,
+                parent_cluster=cluster_index,
+            )
+
+    def compact_directory_data(self, cluster_chain: list[int]) -> bytes:
+        """
+        Собирает содержимое каталога без удалённых записей (0xE5) до первой пустой записи.
+        """
+        entries = bytearray()
         for cluster in cluster_chain:
             cluster_data = self.fat_reader.read_cluster_data(cluster)
-            lfn_entries = []
             for i in range(0, len(cluster_data), ENTRY_SIZE):
-                entry = cluster_data[i:i + ENTRY_SIZE]
-                if entry[0] == EMPTY_ENTRY_MARK:
-                    break
-                if entry[0] == DELETED_ENTRY_MARK:
+                if cluster_data[i] == EMPTY_ENTRY_MARK:
+                    return bytes(entries)
+                if cluster_data[i] == DELETED_ENTRY_MARK:
                     continue
+                entries += cluster_data[i:i + ENTRY_SIZE]
+        return bytes(entries)
 
-                attrs = FatAttributes(entry[11])
-                if (attrs & FatAttributes.LONG_NAME) == FatAttributes.LONG_NAME:
-                    lfn_part = self.parse_lfn_entry(entry)
-                    lfn_entries.insert(0, lfn_part)
-                    continue
-
-                if lfn_entries:
-                    full_name = ''.join(lfn_entries)
-                    full_name = ''.join(c for c in full_name if c.isprintable())
-                    lfn_entries = []
-                else:
-                    name = entry[0:8].decode('ascii', errors='ignore').strip()
-                    extension = entry[8:11].decode('ascii', errors='ignore').strip()
-                    full_name = f"{name}.{extension}" if extension else name
-
-                if full_name.lower() == target_name.lower():
-                    cluster_offset = self.fat_reader.get_cluster_offset(cluster.index)
-                    entry_offset = cluster_offset + i
-                    return entry_offset, cluster.index
-
-        return None
-
-    def navigate_path(self, path_parts: list[str]) -> int | None:
+    def count_deleted_entries(self, cluster_chain: list[int]) -> int:
         """
-        Переходит по пути, возвращая кластер каталога, в котором находится последний элемент.
+        Считает удалённые записи (0xE5) каталога до первой пустой записи
         """
-        current_cluster = self.fat_reader.bpb.root_clus
-        for part in path_parts[:-1]:
-            found_cluster = self.find_subdirectory_cluster(current_cluster, part)
-            if found_cluster is None:
-                print(f"Каталог '{part}' не найден.")
-                return None
-            current_cluster = found_cluster
-        return current_cluster
-
-    def find_subdirectory_cluster(self, dir_cluster_index: int, subdir_name: str) -> int | None:
-        """
-        Ищет подкаталог subdir_name в заданном каталоге, возвращает кластер этого подкаталога
-        """
-        cluster_chain = self.fat_reader.get_cluster_chain(dir_cluster_index)
-
+        deleted_entries = 0
         for cluster in cluster_chain:
             cluster_data = self.fat_reader.read_cluster_data(cluster)
-            entries = self.parse_directory_entries(cluster_data)
-            for entry in entries:
-                if entry["name"].lower() == subdir_name.lower() and (entry["attributes"] & FatAttributes.DIRECTORY):
-                    return entry["starting_cluster"]
-        return None
+            for i in range(0, len(cluster_data), ENTRY_SIZE):
+                if cluster_data[i] == EMPTY_ENTRY_MARK:
+                    return deleted_entries
+                if cluster_data[i] == DELETED_ENTRY_MARK:
+                    deleted_entries += 1
+        return deleted_entries
 
-    def update_starting_cluster(self, file_path: str, new_start_cluster_index: int) -> None:
+    def update_dot_entries(self, directory_cluster_index: int, is_root: bool) -> None:
         """
-        Обновляет поле starting_cluster для указанного файла в каталоге.
+        После перемещения каталога обновляет его запись '.' и записи '..' всех его подкаталогов.
+        Для корневого каталога '..' подкаталогов по спецификации указывает на кластер 0.
         """
-        with open(self.fat_reader.image_path, 'r+b') as f:
-            parts = file_path.split('/')
-            current_cluster = self.navigate_path(parts)
-            if current_cluster is None:
-                return
+        image = self.fat_reader.image
+        if not is_root:
+            dot_offset = self.fat_reader.get_cluster_offset(directory_cluster_index)
+            if bytes(image.read(dot_offset, 2)) == b". ":
+                self.write_starting_cluster(dot_offset, directory_cluster_index)
+
+        parent_cluster_index = 0 if is_root else directory_cluster_index
+        for entry in self._directory_entries(directory_cluster_index)[1]:
+            if not (entry.attributes & DIRECTORY_ATTRIBUTE) or not self._is_listed(entry):
+                continue
+            dotdot_offset = self.fat_reader.get_cluster_offset(entry.starting_cluster) + ENTRY_SIZE
+            if bytes(image.read(dotdot_offset, 2)) == b"..":
+                self.write_starting_cluster(dotdot_offset, parent_cluster_index)
 
-            result = self.find_directory_entry(current_cluster, parts[-1])
-            if result is None:
-                print(f"Файл '{file_path}' не найден для обновления starting_cluster.")
-                return
+    def read_starting_cluster(self, entry_offset: int) -> int | None:
+        """
+        Читает starting_cluster записи каталога по её абсолютному смещению в образе;
+        для пустой или удалённой записи возвращает None.
+        """
+        image = self.fat_reader.image
+        if image.read(entry_offset, 1)[0] in (EMPTY_ENTRY_MARK, DELETED_ENTRY_MARK):
+            return None
+        high, = STARTING_CLUSTER_HALF.unpack(image.read(entry_offset + 20, STARTING_CLUSTER_HALF.size))
+        low, = STARTING_CLUSTER_HALF.unpack(image.read(entry_offset + 26, STARTING_CLUSTER_HALF.size))
+        return (high << 16) | low
 
-            entry_offset, cluster_index = result
-            high = (new_start_cluster_index >> 16) & 0xFFFF
-            low = new_start_cluster_index & 0xFFFF
+    def write_starting_cluster(self, entry_offset: int, new_start_cluster_index: int) -> None:
+        """
+        Записывает starting_cluster в запись каталога по её абсолютному смещению в образе.
+        """
+        high = (new_start_cluster_index >> 16) & 0xFFFF
+        low = new_start_cluster_index & 0xFFFF
 
-            f.seek(entry_offset + 20)
-            f.write(struct.pack("<H", high))
-            f.seek(entry_offset + 26)
-            f.write(struct.pack("<H", low))
-            print(f"Updated starting_cluster for '{file_path}' to {new_start_cluster_index}.")
\ No newline at end of file
+        image = self.fat_reader.image
+        image.write(entry_offset + 20, STARTING_CLUSTER_HALF.pack(high))
+        image.write(entry_offset + 26, STARTING_CLUSTER_HALF.pack(low))
@@ -0,0 +1,146 @@
+import mmap
+import os
+import shutil
+import time
+from collections.abc import Callable
+from pathlib import Path
+from types import TracebackType
+
+DEFAULT_COPY_CHUNK_SIZE = 8 * 1024 * 1024
+
+class IoThrottle:
+    """
+    Ограничитель скорости ввода-вывода: после каждой порции ждёт, пока средняя скорость
+    с момента создания не опустится до max_bytes_per_second
+    """
+    def __init__(self, max_bytes_per_second: int) -> None:
+        self.max_bytes_per_second = max_bytes_per_second
+        self._started = time.monotonic()
+        self._bytes = 0
+
+    def consume(self, size: int) -> None:
+        self._bytes += size
+        delay = self._bytes / self.max_bytes_per_second - (time.monotonic() - self._started)
+        if delay > 0:
+            time.sleep(delay)
+
+def copy_image(source_path: Path, target_path: Path, throttle: IoThrottle | None = None,
+               chunk_size: int = DEFAULT_COPY_CHUNK_SIZE) -> None:
+    """
+    Копирует образ целиком; при заданном throttle - порциями с ограничением скорости
+    """
+    if throttle is None:
+        shutil.copyfile(source_path, target_path)
+        return
+    with open(source_path, 'rb') as source, open(target_path, 'wb') as target:
+        while chunk := source.read(chunk_size):
+            target.write(chunk)
+            throttle.consume(len(chunk))
+
+class DiskImage:
+    """
+    Класс для доступа к образу диска через единственное отображение файла в память
+    """
+    def __init__(self, image_path: Path, writable: bool = True, throttle: IoThrottle | None = None) -> None:
+        self.image_path = image_path
+        self.writable = writable
+        self.throttle = throttle
+        self._file = open(image_path, 'r+b' if writable else 'rb')
+        access = mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=access)
+        self._view = memoryview(self._mmap)
+        self.size = len(self._mmap)
+        self._use_copy_file_range = writable and hasattr(os, 'copy_file_range')
+        self._write_listeners: list[Callable[[int, int], None]] = []
+
+    def add_write_listener(self, listener: Callable[[int, int], None]) -> None:
+        """
+        Регистрирует обработчик listener(offset, size), вызываемый перед каждой записью в образ
+        """
+        self._write_listeners.append(listener)
+
+    def _notify_write(self, offset: int, size: int) -> None:
+        for listener in self._write_listeners:
+            listener(offset, size)
+
+    def read(self, offset: int, size: int) -> memoryview:
+        """
+        Возвращает срез образа без копирования данных
+        """
+        return self._view[offset:offset + size]
+
+    def write(self, offset: int, data: bytes | memoryview) -> None:
+        """
+        Записывает данные в образ по заданному смещению
+        """
+        self._notify_write(offset, len(data))
+        self._view[offset:offset + len(data)] = data
+        if self.throttle is not None:
+            self.throttle.consume(len(data))
+
+    def copy(self, src_offset: int, dst_offset: int, size: int, buffer_size: int) -> None:
+        """
+        Копирует непересекающийся диапазон образа внутри ядра, если это возможно,
+        иначе - через отображение порциями не больше buffer_size. При заданном throttle
+        скорость ограничивается после каждой порции.
+        """
+        self._notify_write(dst_offset, size)
+        if self.throttle is None:
+            self._copy(src_offset, dst_offset, size, buffer_size)
+            return
+        for chunk_offset in range(0, size, buffer_size):
+            chunk_size = min(buffer_size, size - chunk_offset)
+            self._copy(src_offset + chunk_offset, dst_offset + chunk_offset, chunk_size, buffer_size)
+            self.throttle.consume(chunk_size)
+
+    def _copy(self, src_offset: int, dst_offset: int, size: int, buffer_size: int) -> None:
+        if self._use_copy_file_range:
+            try:
+                self._copy_file_range(src_offset, dst_offset, size, buffer_size)
+                return
+            except OSError:
+                self._use_copy_file_range = False
+
+        for chunk_offset in range(0, size, buffer_size):
+            chunk_size = min(buffer_size, size - chunk_offset)
+            self._view[dst_offset + chunk_offset:dst_offset + chunk_offset + chunk_size] = \
+                self.read(src_offset + chunk_offset, chunk_size)
+
+    def _copy_file_range(self, src_offset: int, dst_offset: int, size: int, buffer_size: int) -> None:
+        """
+        Копирует диапазон образа системным вызовом copy_file_range
+        """
+        fd = self._file.fileno()
+        copied = 0
+        while copied < size:
+            count = os.copy_file_range(fd, fd, min(buffer_size, size - copied),
+                                       src_offset + copied, dst_offset + copied)
+            if count == 0:
+                raise OSError("copy_file_range вернул 0 байт")
+            copied += count
+
+    def flush(self) -> None:
+        """
+        Сбрасывает изменения на диск
+        """
+        if self.writable:
+            self._mmap.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        """
+        Сбрасывает изменения и закрывает образ
+        """
+        if self._mmap.closed:
+            return
+        self.flush()
+        self._view.release()
+        self._mmap.close()
+        self._file.close()
+
+    def __enter__(self) -> "DiskImage":
+        return self
+
+    def __exit__(self, exc_type: type[BaseException] | None, exc: BaseException | None,
+                 traceback: TracebackType | None) -> None:
+        self.close()
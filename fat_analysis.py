@@ -0,0 +1,107 @@
+from array import array
+
+from free_space import FreeExtent, group_runs
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+HAS_NUMPY = np is not None
+
+FAT_ENTRY_MASK = 0x0FFFFFFF
+FAT_END_MASK = 0x0FFFFFF8
+FAT_FREE_MASK = 0x00000000
+MIN_VALID_INDEX = 2
+
+def find_free_clusters(fat: array, total_clusters: int) -> list[int]:
+    """
+    Находит все свободные кластеры
+    """
+    if HAS_NUMPY:
+        values = np.frombuffer(fat, dtype=np.uint32, count=total_clusters)[MIN_VALID_INDEX:]
+        return (np.flatnonzero((values & FAT_ENTRY_MASK) == FAT_FREE_MASK) + MIN_VALID_INDEX).tolist()
+
+    return [
+        index for index in range(MIN_VALID_INDEX, total_clusters)
+        if fat[index] & FAT_ENTRY_MASK == FAT_FREE_MASK
+    ]
+
+def find_free_blocks(fat: array, total_clusters: int) -> list[FreeExtent]:
+    """
+    Находит все непрерывные блоки свободных кластеров в виде (start, length)
+    """
+    if HAS_NUMPY:
+        values = np.frombuffer(fat, dtype=np.uint32, count=total_clusters)[MIN_VALID_INDEX:]
+        free = ((values & FAT_ENTRY_MASK) == FAT_FREE_MASK).view(np.int8)
+        boundaries = np.diff(free, prepend=np.int8(0), append=np.int8(0))
+        starts = np.flatnonzero(boundaries == 1)
+        ends = np.flatnonzero(boundaries == -1)
+        return list(zip((starts + MIN_VALID_INDEX).tolist(), (ends - starts).tolist()))
+
+    return group_runs(find_free_clusters(fat, total_clusters))
+
+def find_fragmented_links(fat: array, total_clusters: int) -> list[int]:
+    """
+    Находит кластеры, ссылка которых ведёт не на следующий по порядку кластер (next != index + 1)
+    """
+    if HAS_NUMPY:
+        next_indices = np.frombuffer(fat, dtype=np.uint32, count=total_clusters) & FAT_ENTRY_MASK
+        indices = np.arange(total_clusters, dtype=np.uint32)
+        is_link = (next_indices >= MIN_VALID_INDEX) & (next_indices < FAT_END_MASK)
+        is_link[:MIN_VALID_INDEX] = False
+        return np.flatnonzero(is_link & (next_indices != indices + 1)).tolist()
+
+    fragmented_links: list[int] = []
+    for index in range(MIN_VALID_INDEX, total_clusters):
+        next_index = fat[index] & FAT_ENTRY_MASK
+        if MIN_VALID_INDEX <= next_index < FAT_END_MASK and next_index != index + 1:
+            fragmented_links.append(index)
+    return fragmented_links
+
+def count_fragments(cluster_chain: list[int]) -> int:
+    """
+    Считает число непрерывных фрагментов в цепочке кластеров
+    """
+    if not cluster_chain:
+        return 0
+    if HAS_NUMPY and len(cluster_chain) > 64:
+        return int(np.count_nonzero(np.diff(np.asarray(cluster_chain, dtype=np.int64)) != 1)) + 1
+
+    fragments = 1
+    for position in range(len(cluster_chain) - 1):
+        if cluster_chain[position + 1] != cluster_chain[position] + 1:
+            fragments += 1
+    return fragments
+
+def fragmentation_census(fat: array, total_clusters: int,
+                         free_blocks: list[FreeExtent] | None = None) -> dict[str, int]:
+    """
+    Собирает общую статистику фрагментации по всей FAT таблице; уже найденные свободные блоки
+    можно передать в free_blocks, чтобы не искать их повторно
+    """
+    if free_blocks is None:
+        free_blocks = find_free_blocks(fat, total_clusters)
+    free_clusters_count = sum(length for _, length in free_blocks)
+    return {
+        "total_clusters": total_clusters - MIN_VALID_INDEX,
+        "used_clusters": total_clusters - MIN_VALID_INDEX - free_clusters_count,
+        "free_clusters": free_clusters_count,
+        "free_extents": len(free_blocks),
+        "largest_free_extent": max((length for _, length in free_blocks), default=0),
+        "fragmented_links": len(find_fragmented_links(fat, total_clusters)),
+    }
+
+def free_extent_histogram(free_blocks: list[FreeExtent]) -> dict[str, int]:
+    """
+    Строит гистограмму длин свободных экстентов по степеням двойки: "1", "2-3", "4-7", ...
+    """
+    histogram: dict[str, int] = {}
+    for bucket in sorted({length.bit_length() for _, length in free_blocks}):
+        low, high = 1 << (bucket - 1), (1 << bucket) - 1
+        histogram[str(low) if low == high else f"{low}-{high}"] = 0
+    for _, length in free_blocks:
+        bucket = length.bit_length()
+        low, high = 1 << (bucket - 1), (1 << bucket) - 1
+        histogram[str(low) if low == high else f"{low}-{high}"] += 1
+    return histogram
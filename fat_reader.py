@@ -1,75 +1,318 @@
-import struct
-from pathlib import Path
+import logging
+import sys
+import zlib
+from array import array
+from collections import OrderedDict
+from typing import Any
 
 from bpb import BPB
-from cluster import Cluster
+from disk_image import DiskImage
+from free_space import FreeExtent, chain_to_runs, group_runs, runs_to_chain
 
 FAT_ENTRY_SIZE = 4
 FAT_ENTRY_MASK = 0x0FFFFFFF
 FAT_END_MASK = 0x0FFFFFF8
+FAT_RESERVED_BITS = 0xF0000000
+MAX_VALID_INDEX = 0x0FFFFFF8
+MIN_VALID_INDEX = 2
+DEFAULT_METADATA_CACHE_SIZE = 16 * 1024 * 1024
+INT_OBJECT_SIZE = sys.getsizeof(MAX_VALID_INDEX)
+CACHE_ENTRY_OVERHEAD = sys.getsizeof((None, None, 0)) + sys.getsizeof(OrderedDict(((0, None),))) // 2
+CACHE_CLUSTER_OVERHEAD = sys.getsizeof({0}) + sys.getsizeof({0: None}) // 2
+
+logger = logging.getLogger(__name__)
+
+class ClusterCache:
+    """
+    LRU-кэш данных, полученных из кластеров образа, с ограничением объёма budget в байтах.
+    Каждое значение привязано к кластерам, из которых оно прочитано: запись в любой из них
+    или изменение их записей FAT удаляет значение из кэша. К объёму значения, который оценивает
+    вызывающий, добавляются служебные структуры кэша: запись LRU и множества владельцев кластеров.
+    """
+    def __init__(self, budget: int) -> None:
+        self.budget = budget
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[int, tuple[Any, list[int], int]] = OrderedDict()
+        self._owners: dict[int, set[int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: int) -> Any | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key: int, value: Any, clusters: list[int], size: int) -> None:
+        """
+        Кладёт значение размером около size байт в памяти, прочитанное из кластеров clusters,
+        вытесняя давно не использованные; значение больше всего бюджета не кэшируется
+        """
+        size += CACHE_ENTRY_OVERHEAD + len(clusters) * CACHE_CLUSTER_OVERHEAD
+        if size > self.budget:
+            return
+        self._discard(key)
+        while self.used + size > self.budget:
+            self._discard(next(iter(self._entries)))
+        self._entries[key] = (value, clusters, size)
+        self.used += size
+        for cluster in clusters:
+            self._owners.setdefault(cluster, set()).add(key)
+
+    def invalidate(self, first_cluster: int, clusters_count: int) -> None:
+        """
+        Удаляет значения, прочитанные из кластеров first_cluster..first_cluster + clusters_count - 1
+        """
+        if not self._owners:
+            return
+        last_cluster = first_cluster + clusters_count
+        if clusters_count > len(self._owners):
+            clusters = [cluster for cluster in self._owners if first_cluster <= cluster < last_cluster]
+        else:
+            clusters = [cluster for cluster in range(first_cluster, last_cluster) if cluster in self._owners]
+        for cluster in clusters:
+            for key in list(self._owners.get(cluster, ())):
+                self._discard(key)
+
+    def _discard(self, key: int) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        _, clusters, size = entry
+        self.used -= size
+        for cluster in clusters:
+            owners = self._owners.get(cluster)
+            if owners is not None:
+                owners.discard(key)
+                if not owners:
+                    del self._owners[cluster]
 
 class FatReader:
     """
     Класс для чтения FAT таблицы
     """
-    def __init__(self, image_path: Path, bpb: BPB) -> None:
-        self.image_path = image_path
+    def __init__(self, image: DiskImage, bpb: BPB, metadata_cache_size: int = DEFAULT_METADATA_CACHE_SIZE) -> None:
+        self.image = image
         self.bpb = bpb
         self.cluster_size = self.bpb.sec_per_clus * self.bpb.byts_per_sec
-        self.clusters: list[Cluster] = self._read_fat()
+        self.fat: array = self._read_fat()
+        self.total_clusters = min(len(self.fat), self._count_data_clusters() + MIN_VALID_INDEX)
+        self._entries_per_sector = self.bpb.byts_per_sec // FAT_ENTRY_SIZE
+        self._dirty_sectors: set[int] = set()
+        self._chain_cache: dict[int, list[FreeExtent]] | None = None
+        self._changed_sectors: set[int] = set()
+        self._data_offset = self.get_cluster_offset(MIN_VALID_INDEX)
+        self.metadata_cache = ClusterCache(metadata_cache_size)
+        self.image.add_write_listener(self._invalidate_written)
 
-    def _read_fat(self) -> list[Cluster]:
+    def _read_fat(self) -> array:
         """
-        Читает FAT таблицу, разбивая ее на кластеры
+        Читает FAT таблицу целиком одним чтением в компактный массив 32-битных записей
         """
-        fat_start = self.bpb.reserved_sec_cnt * self.bpb.byts_per_sec
         fat_size = self.bpb.fat_size_32 * self.bpb.byts_per_sec
+        fat_start = self.get_fat_offset(self.bpb.active_fats()[0])
         max_clusters = fat_size // FAT_ENTRY_SIZE
-        clusters: list[Cluster] = []
 
-        with open(self.image_path, 'rb') as image_file:
-            image_file.seek(fat_start)
-            fat_data = image_file.read(fat_size)
+        fat_data = self.image.read(fat_start, max_clusters * FAT_ENTRY_SIZE)
 
-            for i in range(0, len(fat_data), FAT_ENTRY_SIZE):
-                entry_data = fat_data[i:i + FAT_ENTRY_SIZE]
-                cluster_value = struct.unpack("<I", entry_data)[0] & FAT_ENTRY_MASK
-                if len(clusters) >= max_clusters:
-                    break
-                is_end = cluster_value >= FAT_END_MASK
-                clusters.append(Cluster(index=i // FAT_ENTRY_SIZE, next_index=cluster_value, is_end=is_end))
-        return clusters
+        fat = array('I')
+        fat.frombytes(fat_data[:len(fat_data) - len(fat_data) % FAT_ENTRY_SIZE])
+        if sys.byteorder == 'big':
+            fat.byteswap()
+        return fat
+
+    def _count_data_clusters(self) -> int:
+        """
+        Вычисляет количество кластеров в области данных
+        """
+        data_region = self.bpb.reserved_sec_cnt + (self.bpb.num_fats * self.bpb.fat_size_32)
+        return (self.bpb.total_sec_32 - data_region) // self.bpb.sec_per_clus
+
+    def get_fat_offset(self, fat_number: int) -> int:
+        """
+        Вычисляет смещение копии FAT с заданным номером в байтах
+        """
+        return (self.bpb.reserved_sec_cnt + fat_number * self.bpb.fat_size_32) * self.bpb.byts_per_sec
+
+    @property
+    def dirty_sectors_count(self) -> int:
+        return len(self._dirty_sectors)
+
+    def flush_fat(self) -> None:
+        """
+        Записывает изменённые секторы FAT во все поддерживаемые копии FAT за один проход,
+        объединяя соседние секторы в одну запись
+        """
+        for first_sector, sectors_count in group_runs(sorted(self._dirty_sectors)):
+            first_entry = first_sector * self._entries_per_sector
+            entries = self.fat[first_entry:first_entry + sectors_count * self._entries_per_sector]
+            if sys.byteorder == 'big':
+                entries.byteswap()
+            sectors_data = entries.tobytes()
+            for fat_number in self.bpb.active_fats():
+                self.image.write(self.get_fat_offset(fat_number) + first_sector * self.bpb.byts_per_sec, sectors_data)
+        self._dirty_sectors.clear()
+
+    def get_next_index(self, cluster_index: int) -> int:
+        """
+        Возвращает значение записи FAT для кластера без зарезервированных битов
+        """
+        return self.fat[cluster_index] & FAT_ENTRY_MASK
+
+    def set_next_index(self, cluster_index: int, next_index: int) -> None:
+        """
+        Записывает значение в FAT, сохраняя зарезервированные старшие биты записи, и помечает сектор изменённым
+        """
+        self.fat[cluster_index] = (self.fat[cluster_index] & FAT_RESERVED_BITS) | (next_index & FAT_ENTRY_MASK)
+        sector = cluster_index // self._entries_per_sector
+        self._dirty_sectors.add(sector)
+        if self._chain_cache is not None:
+            self._changed_sectors.add(sector)
+        if self.metadata_cache:
+            self.metadata_cache.invalidate(cluster_index, 1)
+
+    def data_clusters(self, offset: int, size: int) -> FreeExtent | None:
+        """
+        Возвращает кластеры области данных (start, length), затронутые диапазоном образа, или None
+        """
+        end = offset + size
+        if end <= self._data_offset:
+            return None
+        first_cluster = MIN_VALID_INDEX + (max(offset, self._data_offset) - self._data_offset) // self.cluster_size
+        last_cluster = MIN_VALID_INDEX + (end - 1 - self._data_offset) // self.cluster_size
+        return first_cluster, last_cluster - first_cluster + 1
 
-    def get_cluster_chain(self, start_cluster_index: int) -> list[Cluster]:
+    def _invalidate_written(self, offset: int, size: int) -> None:
         """
-        Возвращает цепочку кластеров
+        Сбрасывает кэш метаданных для кластеров области данных, затронутых записью в образ
         """
-        chain: list[Cluster] = []
+        if not self.metadata_cache:
+            return
+        clusters = self.data_clusters(offset, size)
+        if clusters is not None:
+            self.metadata_cache.invalidate(*clusters)
+
+    def is_free(self, cluster_index: int) -> bool:
+        """
+        Проверяет, свободен ли кластер
+        """
+        return self.fat[cluster_index] & FAT_ENTRY_MASK == 0
+
+    @property
+    def changed_sectors(self) -> set[int]:
+        """
+        Секторы FAT, изменённые после включения кэша цепочек
+        """
+        return self._changed_sectors
+
+    def _fat_bytes(self) -> memoryview:
+        """
+        Загруженная FAT в порядке байтов образа; совпадает с образом, пока нет несброшенных секторов
+        """
+        if sys.byteorder == 'big':
+            fat = array('I', self.fat)
+            fat.byteswap()
+            return memoryview(fat).cast('B')
+        return memoryview(self.fat).cast('B')
+
+    def sector_checksums(self) -> list[int]:
+        """
+        Возвращает CRC32 каждого сектора FAT, считая их по уже загруженной таблице, а не по образу
+        """
+        sector_size = self.bpb.byts_per_sec
+        fat_data = self._fat_bytes()
+        return [zlib.crc32(fat_data[offset:offset + sector_size]) for offset in range(0, len(fat_data), sector_size)]
+
+    def sector_checksum(self, sector: int) -> int:
+        """
+        Возвращает CRC32 одного сектора загруженной FAT
+        """
+        entries = self.fat[sector * self._entries_per_sector:(sector + 1) * self._entries_per_sector]
+        if sys.byteorder == 'big':
+            entries.byteswap()
+        return zlib.crc32(entries)
+
+    def chain_touches_sectors(self, runs: list[FreeExtent], sectors: set[int]) -> bool:
+        """
+        Проверяет, лежит ли запись FAT хотя бы одного кластера отрезков runs в одном из секторов sectors
+        """
+        if not sectors:
+            return False
+        for start, length in runs:
+            first_sector = start // self._entries_per_sector
+            last_sector = (start + length - 1) // self._entries_per_sector
+            if any(sector in sectors for sector in range(first_sector, last_sector + 1)):
+                return True
+        return False
+
+    def enable_chain_cache(self, known_chains: dict[int, list[FreeExtent]] | None = None) -> None:
+        """
+        Включает кэш цепочек по начальному кластеру, заполняя его заведомо актуальными цепочками
+        known_chains. Закэшированная цепочка, записи FAT которой менялись после включения кэша,
+        строится заново.
+        """
+        self._chain_cache = dict(known_chains or {})
+        self._changed_sectors = set()
+
+    def cached_chain_runs(self, start_cluster_index: int) -> list[FreeExtent] | None:
+        """
+        Возвращает отрезки закэшированной цепочки, если она ещё актуальна
+        """
+        if self._chain_cache is None:
+            return None
+        runs = self._chain_cache.get(start_cluster_index)
+        if runs is None or self.chain_touches_sectors(runs, self._changed_sectors):
+            return None
+        return runs
+
+    def get_cluster_chain(self, start_cluster_index: int) -> list[int]:
+        """
+        Возвращает цепочку индексов кластеров
+        """
+        if self._chain_cache is None:
+            return self._walk_chain(start_cluster_index)
+        runs = self.cached_chain_runs(start_cluster_index)
+        if runs is not None:
+            return runs_to_chain(runs)
+        chain = self._walk_chain(start_cluster_index)
+        if chain:
+            self._chain_cache[start_cluster_index] = chain_to_runs(chain)
+        return chain
+
+    def _walk_chain(self, start_cluster_index: int) -> list[int]:
+        """
+        Проходит цепочку кластеров по FAT
+        """
+        fat = self.fat
+        fat_len = len(fat)
+        chain: list[int] = []
         current_cluster_index: int = start_cluster_index
         visited: set[int] = set()
-        while 2 <= current_cluster_index < len(self.clusters) and self.clusters[current_cluster_index].is_valid():
+        while MIN_VALID_INDEX <= current_cluster_index < min(fat_len, MAX_VALID_INDEX):
             if current_cluster_index in visited:
-                print(f"Цикл обнаружен в цепочке кластеров: {current_cluster_index}")
+                logger.warning("Цикл обнаружен в цепочке кластеров: %d", current_cluster_index)
                 break
 
             visited.add(current_cluster_index)
-            cluster_obj = self.clusters[current_cluster_index]
-            chain.append(cluster_obj)
-            if cluster_obj.is_end:
+            chain.append(current_cluster_index)
+            next_index = fat[current_cluster_index] & FAT_ENTRY_MASK
+            if next_index >= FAT_END_MASK:
                 break
 
-            current_cluster_index = cluster_obj.next_index
+            current_cluster_index = next_index
         return chain
 
-    def read_cluster_data(self, cluster: Cluster) -> bytes:
+    def read_cluster_data(self, cluster_index: int) -> memoryview:
         """
-        Читает данные кластера
+        Читает данные кластера без копирования
         """
-        cluster_offset = self.get_cluster_offset(cluster.index)
-
-        with open(self.image_path, 'rb') as image_file:
-            image_file.seek(cluster_offset)
-            return image_file.read(self.cluster_size)
+        return self.image.read(self.get_cluster_offset(cluster_index), self.cluster_size)
 
     def get_cluster_offset(self, cluster_index: int) -> int:
         """
@@ -0,0 +1,352 @@
+import sys
+from bisect import bisect_left, bisect_right, insort
+from collections.abc import Iterable, Iterator
+from itertools import chain
+from operator import itemgetter
+from typing import Any
+
+FreeExtent = tuple[int, int]
+
+BLOCK_SIZE = 512
+
+extent_length = itemgetter(1)
+
+class SortedBlockList:
+    """
+    Отсортированный список, разбитый на блоки длиной до 2 * BLOCK_SIZE. Блок ищется bisect по первым
+    ключам блоков, вставка и удаление сдвигают элементы только внутри одного блока, поэтому операции
+    стоят O(log n + BLOCK_SIZE), а не O(n), как у одного большого списка.
+    """
+    def __init__(self, sorted_keys: Iterable[Any] = ()) -> None:
+        keys = list(sorted_keys)
+        self._blocks: list[list[Any]] = [keys[i:i + BLOCK_SIZE] for i in range(0, len(keys), BLOCK_SIZE)]
+        self._firsts: list[Any] = [block[0] for block in self._blocks]
+        self._length = len(keys)
+        self._blocks_built()
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __iter__(self) -> Iterator[Any]:
+        return chain.from_iterable(self._blocks)
+
+    def add(self, key: Any) -> None:
+        self._length += 1
+        if not self._blocks:
+            self._blocks.append([key])
+            self._firsts.append(key)
+            self._blocks_built()
+            return
+        block_index = max(0, bisect_right(self._firsts, key) - 1)
+        block = self._blocks[block_index]
+        insort(block, key)
+        self._firsts[block_index] = block[0]
+        if len(block) > 2 * BLOCK_SIZE:
+            self._blocks[block_index:block_index + 1] = [block[:BLOCK_SIZE], block[BLOCK_SIZE:]]
+            self._firsts[block_index:block_index + 1] = [block[0], block[BLOCK_SIZE]]
+            self._block_split(block_index)
+        else:
+            self._key_added(block_index, key)
+
+    def remove(self, key: Any) -> None:
+        block_index = max(0, bisect_right(self._firsts, key) - 1)
+        block = self._blocks[block_index] if self._blocks else []
+        position = bisect_left(block, key)
+        if position == len(block) or block[position] != key:
+            raise ValueError(f"{key} отсутствует в списке.")
+        del block[position]
+        self._length -= 1
+        if block:
+            self._firsts[block_index] = block[0]
+            self._key_removed(block_index, key)
+        else:
+            del self._blocks[block_index]
+            del self._firsts[block_index]
+            self._block_deleted(block_index)
+
+    def ceiling(self, key: Any) -> Any | None:
+        """
+        Возвращает наименьший элемент не меньше key или None
+        """
+        if not self._blocks:
+            return None
+        block_index = max(0, bisect_right(self._firsts, key) - 1)
+        block = self._blocks[block_index]
+        position = bisect_left(block, key)
+        if position < len(block):
+            return block[position]
+        return self._blocks[block_index + 1][0] if block_index + 1 < len(self._blocks) else None
+
+    def floor(self, key: Any) -> Any | None:
+        """
+        Возвращает наибольший элемент не больше key или None
+        """
+        block_index = bisect_right(self._firsts, key) - 1
+        if block_index < 0:
+            return None
+        block = self._blocks[block_index]
+        return block[bisect_right(block, key) - 1]
+
+    def first(self) -> Any | None:
+        return self._blocks[0][0] if self._blocks else None
+
+    def last(self) -> Any | None:
+        return self._blocks[-1][-1] if self._blocks else None
+
+    def _blocks_built(self) -> None:
+        pass
+
+    def _block_split(self, block_index: int) -> None:
+        pass
+
+    def _block_deleted(self, block_index: int) -> None:
+        pass
+
+    def _key_added(self, block_index: int, key: Any) -> None:
+        pass
+
+    def _key_removed(self, block_index: int, key: Any) -> None:
+        pass
+
+class ExtentsByAddress(SortedBlockList):
+    """
+    Свободные экстенты (start, length) в порядке адресов с деревом отрезков максимальных длин
+    по блокам: поиск первого или последнего по адресу экстента нужной длины спускается по дереву
+    за O(log n) и просматривает один блок.
+    """
+    def first_fit(self, clusters_count: int) -> FreeExtent | None:
+        block = self._fit_block(clusters_count, prefer_left=True)
+        if block is None:
+            return None
+        return next(extent for extent in block if extent[1] >= clusters_count)
+
+    def last_fit(self, clusters_count: int) -> FreeExtent | None:
+        block = self._fit_block(clusters_count, prefer_left=False)
+        if block is None:
+            return None
+        return next(extent for extent in reversed(block) if extent[1] >= clusters_count)
+
+    def _fit_block(self, clusters_count: int, prefer_left: bool) -> list[FreeExtent] | None:
+        tree = self._tree
+        if tree[1] < clusters_count:
+            return None
+        node = 1
+        while node < self._tree_size:
+            first, second = (2 * node, 2 * node + 1) if prefer_left else (2 * node + 1, 2 * node)
+            node = first if tree[first] >= clusters_count else second
+        return self._blocks[node - self._tree_size]
+
+    def _blocks_built(self) -> None:
+        self._maxes = [max(block, key=extent_length)[1] for block in self._blocks]
+        self._rebuild_tree()
+
+    def _block_split(self, block_index: int) -> None:
+        self._maxes[block_index:block_index + 1] = [
+            max(block, key=extent_length)[1] for block in self._blocks[block_index:block_index + 2]
+        ]
+        self._rebuild_tree()
+
+    def _block_deleted(self, block_index: int) -> None:
+        del self._maxes[block_index]
+        self._rebuild_tree()
+
+    def _key_added(self, block_index: int, key: FreeExtent) -> None:
+        if key[1] > self._maxes[block_index]:
+            self._maxes[block_index] = key[1]
+            self._update_tree(block_index)
+
+    def _key_removed(self, block_index: int, key: FreeExtent) -> None:
+        if key[1] == self._maxes[block_index]:
+            self._maxes[block_index] = max(self._blocks[block_index], key=extent_length)[1]
+            self._update_tree(block_index)
+
+    def _update_tree(self, block_index: int) -> None:
+        tree = self._tree
+        node = self._tree_size + block_index
+        tree[node] = self._maxes[block_index]
+        node //= 2
+        while node:
+            left, right = tree[2 * node], tree[2 * node + 1]
+            value = left if left > right else right
+            if tree[node] == value:
+                return
+            tree[node] = value
+            node //= 2
+
+    def _rebuild_tree(self) -> None:
+        """
+        Перестраивает внутренние узлы дерева по максимумам блоков за O(n / BLOCK_SIZE)
+        """
+        tree_size = 1
+        while tree_size < len(self._maxes):
+            tree_size *= 2
+        tree = [0] * tree_size + self._maxes + [0] * (tree_size - len(self._maxes))
+        for node in range(tree_size - 1, 0, -1):
+            left, right = tree[2 * node], tree[2 * node + 1]
+            tree[node] = left if left > right else right
+        self._tree_size = tree_size
+        self._tree = tree
+
+class FreeExtentIndex:
+    """
+    Индекс свободных экстентов: экстенты, отсортированные по размеру и по адресу, и словари
+    начало->длина и конец->начало для слияния освобождённых кластеров с соседями. Поиск, выделение
+    и освобождение стоят O(log n + BLOCK_SIZE), индекс строится одной сортировкой.
+    """
+    def __init__(self, extents: Iterable[FreeExtent] = ()) -> None:
+        merged: list[FreeExtent] = []
+        for start, length in sorted(extents):
+            if length <= 0:
+                continue
+            if merged and start <= merged[-1][0] + merged[-1][1]:
+                previous_start, previous_length = merged[-1]
+                merged[-1] = (previous_start, max(previous_start + previous_length, start + length) - previous_start)
+            else:
+                merged.append((start, length))
+        self._by_size = SortedBlockList(sorted((length, start) for start, length in merged))
+        self._by_address = ExtentsByAddress(merged)
+        self._length_by_start: dict[int, int] = dict(merged)
+        self._start_by_end: dict[int, int] = {start + length: start for start, length in merged}
+        self.free_clusters_count = sum(length for _, length in merged)
+
+    def __len__(self) -> int:
+        return len(self._by_size)
+
+    def length_at(self, start: int) -> int:
+        """
+        Возвращает длину свободного экстента, начинающегося ровно с кластера start, или 0
+        """
+        return self._length_by_start.get(start, 0)
+
+    def first_free(self) -> int | None:
+        """
+        Возвращает первый свободный кластер по адресу
+        """
+        first = self._by_address.first()
+        return first[0] if first is not None else None
+
+    def find_best_fit(self, clusters_count: int) -> FreeExtent | None:
+        """
+        Находит наименьший экстент, вмещающий clusters_count кластеров (Best-Fit)
+        """
+        found = self._by_size.ceiling((clusters_count, -1))
+        if found is None:
+            return None
+        length, start = found
+        return start, length
+
+    def find_last_fit(self, clusters_count: int) -> FreeExtent | None:
+        """
+        Находит последний по адресу экстент, вмещающий clusters_count кластеров
+        """
+        return self._by_address.last_fit(clusters_count)
+
+    def allocate(self, start: int, clusters_count: int) -> None:
+        """
+        Помечает занятыми кластеры [start, start + clusters_count), которые должны быть свободны
+        """
+        extent_start = self._find_containing(start)
+        if extent_start is None:
+            raise ValueError(f"Кластер {start} не свободен.")
+        extent_length = self._length_by_start[extent_start]
+        if start + clusters_count > extent_start + extent_length:
+            raise ValueError(f"Кластеры {start}..{start + clusters_count - 1} не свободны целиком.")
+
+        self._remove(extent_start, extent_length)
+        if start > extent_start:
+            self._add(extent_start, start - extent_start)
+        tail_start = start + clusters_count
+        tail_length = extent_start + extent_length - tail_start
+        if tail_length > 0:
+            self._add(tail_start, tail_length)
+        self.free_clusters_count -= clusters_count
+
+    def free(self, start: int, clusters_count: int) -> None:
+        """
+        Возвращает кластеры [start, start + clusters_count), которые должны быть заняты, в индекс,
+        сливая их с соседними экстентами
+        """
+        if clusters_count <= 0:
+            return
+        end = start + clusters_count
+        last_before_end = self._by_address.floor((end - 1, sys.maxsize))
+        if last_before_end is not None and last_before_end[0] + last_before_end[1] > start:
+            raise ValueError(f"Кластеры {start}..{end - 1} уже частично свободны.")
+        self.free_clusters_count += clusters_count
+
+        previous_start = self._start_by_end.get(start)
+        if previous_start is not None:
+            self._remove(previous_start, start - previous_start)
+            start = previous_start
+
+        next_length = self._length_by_start.get(end)
+        if next_length is not None:
+            self._remove(end, next_length)
+            end += next_length
+
+        self._add(start, end - start)
+
+    def free_clusters(self, clusters: Iterable[int]) -> None:
+        """
+        Возвращает в индекс произвольный набор кластеров, объединяя соседние в экстенты
+        """
+        for start, length in group_runs(sorted(clusters)):
+            self.free(start, length)
+
+    def _find_containing(self, cluster: int) -> int | None:
+        """
+        Возвращает начало свободного экстента, содержащего кластер
+        """
+        if cluster in self._length_by_start:
+            return cluster
+        extent = self._by_address.floor((cluster, sys.maxsize))
+        if extent is not None and cluster < extent[0] + extent[1]:
+            return extent[0]
+        return None
+
+    def _add(self, start: int, length: int) -> None:
+        self._by_size.add((length, start))
+        self._by_address.add((start, length))
+        self._length_by_start[start] = length
+        self._start_by_end[start + length] = start
+
+    def _remove(self, start: int, length: int) -> None:
+        self._by_size.remove((length, start))
+        self._by_address.remove((start, length))
+        del self._length_by_start[start]
+        del self._start_by_end[start + length]
+
+def group_runs(sorted_clusters: Iterable[int]) -> list[FreeExtent]:
+    """
+    Группирует отсортированные индексы кластеров в непрерывные отрезки (start, length)
+    """
+    runs: list[FreeExtent] = []
+    run_start = run_length = 0
+    for cluster in sorted_clusters:
+        if run_length and cluster == run_start + run_length:
+            run_length += 1
+            continue
+        if run_length:
+            runs.append((run_start, run_length))
+        run_start, run_length = cluster, 1
+    if run_length:
+        runs.append((run_start, run_length))
+    return runs
+
+def chain_to_runs(cluster_chain: list[int]) -> list[FreeExtent]:
+    """
+    Сжимает цепочку кластеров в список отрезков (start, length) с сохранением порядка цепочки
+    """
+    runs: list[list[int]] = []
+    for cluster in cluster_chain:
+        if runs and cluster == runs[-1][0] + runs[-1][1]:
+            runs[-1][1] += 1
+        else:
+            runs.append([cluster, 1])
+    return [(start, length) for start, length in runs]
+
+def runs_to_chain(runs: list[FreeExtent]) -> list[int]:
+    """
+    Восстанавливает цепочку кластеров из списка отрезков (start, length)
+    """
+    return [cluster for start, length in runs for cluster in range(start, start + length)]
@@ -0,0 +1,359 @@
+import argparse
+import random
+import struct
+import sys
+from array import array
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from bpb import FSINFO_LEAD_SIG, FSINFO_STRUC_SIG
+from directory_parser import DELETED_ENTRY_MARK, ENTRY_SIZE, DirectoryParser
+from disk_image import DiskImage
+from fat_attributes import FatAttributes
+from fat_reader import FAT_ENTRY_MASK, FAT_ENTRY_SIZE, MIN_VALID_INDEX, FatReader
+from free_space import FreeExtent
+
+BYTES_PER_SECTOR = 512
+RESERVED_SECTORS = 32
+NUM_FATS = 2
+FS_INFO_SECTOR = 1
+BACKUP_BOOT_SECTOR = 6
+MEDIA_DESCRIPTOR = 0xF8
+FAT_MEDIA_ENTRY = 0x0FFFFFF8
+LFN_CHARS_PER_ENTRY = 13
+LFN_LAST_ENTRY_FLAG = 0x40
+MAX_FRAGMENT_CLUSTERS = 8
+MAX_GAP_CLUSTERS = 8
+CLUSTER_MARKER = struct.Struct("<II")
+
+@dataclass
+class ImageSpec:
+    """
+    Параметры синтетического образа FAT32
+    """
+    volume_size: int = 256 * 1024 * 1024
+    cluster_size: int = 4096
+    files: int = 1000
+    directories: int = 50
+    max_depth: int = 4
+    lfn_density: float = 0.5
+    fragmentation: float = 0.5
+    max_file_clusters: int = 64
+    deleted_density: float = 0.1
+    seed: int = 1
+
+@dataclass
+class _Node:
+    path: str
+    short_name: bytes
+    long_name: str | None
+    is_directory: bool
+    parent: int | None
+    clusters_count: int = 0
+    size: int = 0
+    depth: int = 0
+    deleted_before: bool = False
+    children: list[int] = field(default_factory=list)
+    extents: list[FreeExtent] = field(default_factory=list)
+
+class ImageGenerator:
+    """
+    Строит образ FAT32 без mkfs: дерево каталогов заданной глубины, файлы со случайным размером,
+    длинные имена с заданной плотностью и заданная доля фрагментированных цепочек. Первые байты
+    каждого кластера файла содержат номер файла и номер кластера в цепочке, что позволяет
+    проверить целостность данных после дефрагментации.
+    """
+    def __init__(self, spec: ImageSpec) -> None:
+        if spec.cluster_size % BYTES_PER_SECTOR or spec.cluster_size < BYTES_PER_SECTOR:
+            raise ValueError(f"Размер кластера должен быть кратен {BYTES_PER_SECTOR}")
+        self.spec = spec
+        self._random = random.Random(spec.seed)
+        self._sectors_per_cluster = spec.cluster_size // BYTES_PER_SECTOR
+        self._total_sectors = spec.volume_size // BYTES_PER_SECTOR
+        self._fat_size, self.total_clusters = self._layout()
+        self._nodes: list[_Node] = []
+
+    def generate(self, image_path: Path) -> dict:
+        """
+        Записывает образ в image_path и возвращает сводку: число кластеров, файлов, каталогов,
+        фрагментированных файлов и занятых кластеров.
+        """
+        self._nodes = []
+        self._build_tree()
+        self._size_directories()
+        fat = self._allocate()
+
+        with open(image_path, 'wb') as image_file:
+            image_file.truncate(self._total_sectors * BYTES_PER_SECTOR)
+        with DiskImage(image_path) as image:
+            self._write_boot_sectors(image)
+            self._write_fats(image, fat)
+            self._write_directories(image)
+            self._write_file_markers(image)
+
+        files = [node for node in self._nodes if not node.is_directory]
+        return {
+            "total_clusters": self.total_clusters,
+            "cluster_size": self.spec.cluster_size,
+            "files": len(files),
+            "directories": len(self._nodes) - len(files),
+            "fragmented_files": sum(1 for node in files if len(node.extents) > 1),
+            "used_clusters": sum(node.clusters_count for node in self._nodes),
+        }
+
+    def _layout(self) -> tuple[int, int]:
+        """
+        Подбирает размер FAT в секторах так, чтобы таблица покрывала все кластеры области данных
+        """
+        fat_size = 1
+        while True:
+            data_sectors = self._total_sectors - RESERVED_SECTORS - NUM_FATS * fat_size
+            clusters_count = data_sectors // self._sectors_per_cluster
+            if clusters_count <= 0:
+                raise ValueError("Объём тома слишком мал")
+            required = -(-(clusters_count + MIN_VALID_INDEX) * FAT_ENTRY_SIZE // BYTES_PER_SECTOR)
+            if required <= fat_size:
+                return fat_size, clusters_count
+            fat_size = required
+
+    def _build_tree(self) -> None:
+        """
+        Строит дерево: каталоги подвешиваются к случайным каталогам не глубже max_depth,
+        файлы распределяются по всем каталогам
+        """
+        spec = self.spec
+        self._nodes.append(_Node(path="", short_name=b"", long_name=None, is_directory=True, parent=None))
+        parents = [0]
+        for index in range(spec.directories):
+            parent = self._random.choice(parents)
+            node_id = self._add_node(parent, index, True)
+            if self._nodes[node_id].depth < spec.max_depth:
+                parents.append(node_id)
+
+        directories = [node_id for node_id, node in enumerate(self._nodes) if node.is_directory]
+        for index in range(spec.files):
+            node_id = self._add_node(self._random.choice(directories), spec.directories + index, False)
+            node = self._nodes[node_id]
+            node.clusters_count = self._random.randint(0, spec.max_file_clusters)
+            if node.clusters_count:
+                node.size = node.clusters_count * spec.cluster_size - self._random.randrange(spec.cluster_size)
+
+    def _add_node(self, parent: int, index: int, is_directory: bool) -> int:
+        short_name = f"D{index:07d}   ".encode() if is_directory else f"F{index:07d}BIN".encode()
+        long_name = None
+        if self._random.random() < self.spec.lfn_density:
+            long_name = f"directory {index} with a long name" if is_directory else f"file {index} with a long name.dat"
+        name = long_name or (f"D{index:07d}" if is_directory else f"F{index:07d}.BIN")
+        parent_node = self._nodes[parent]
+        node_id = len(self._nodes)
+        self._nodes.append(_Node(
+            path=f"{parent_node.path}/{name}" if parent_node.path else name,
+            short_name=short_name,
+            long_name=long_name,
+            is_directory=is_directory,
+            parent=parent,
+            depth=parent_node.depth + 1,
+            deleted_before=self._random.random() < self.spec.deleted_density,
+        ))
+        parent_node.children.append(node_id)
+        return node_id
+
+    def _size_directories(self) -> None:
+        """
+        Считает число кластеров каждого каталога по числу записей, включая LFN, '.', '..' и удалённые
+        """
+        entries_per_cluster = self.spec.cluster_size // ENTRY_SIZE
+        for node in self._nodes:
+            if not node.is_directory:
+                continue
+            entries_count = 0 if node.parent is None else 2
+            for child_id in node.children:
+                child = self._nodes[child_id]
+                entries_count += 1 + int(child.deleted_before) + self._lfn_entries_count(child)
+            node.clusters_count = max(1, -(-(entries_count + 1) // entries_per_cluster))
+
+    def _lfn_entries_count(self, node: _Node) -> int:
+        if node.long_name is None:
+            return 0
+        return -(-len(node.long_name) // LFN_CHARS_PER_ENTRY)
+
+    def _allocate(self) -> array:
+        """
+        Размещает цепочки: каждая фрагментированная цепочка режется на куски, все куски
+        перемешиваются и раскладываются подряд, между ними с вероятностью fragmentation остаются
+        свободные промежутки. Корневой каталог всегда начинается с кластера 2.
+        """
+        spec = self.spec
+        pieces: list[tuple[int, int]] = []
+        root = self._nodes[0]
+        root.extents.append((MIN_VALID_INDEX, 1))
+        for node_id, node in enumerate(self._nodes):
+            remaining = node.clusters_count - (1 if node_id == 0 else 0)
+            fragmented = self._random.random() < spec.fragmentation
+            while remaining > 0:
+                length = min(remaining, self._random.randint(1, MAX_FRAGMENT_CLUSTERS)) if fragmented else remaining
+                pieces.append((node_id, length))
+                remaining -= length
+        self._random.shuffle(pieces)
+
+        cursor = MIN_VALID_INDEX + 1
+        end = MIN_VALID_INDEX + self.total_clusters
+        for node_id, length in pieces:
+            if self._random.random() < spec.fragmentation:
+                cursor += self._random.randint(1, MAX_GAP_CLUSTERS)
+            if cursor + length > end:
+                raise ValueError("Файлы не помещаются в том, увеличьте volume_size")
+            self._nodes[node_id].extents.append((cursor, length))
+            cursor += length
+
+        fat = array('I', bytes(self._fat_size * BYTES_PER_SECTOR))
+        fat[0] = FAT_MEDIA_ENTRY
+        fat[1] = FAT_ENTRY_MASK
+        for node in self._nodes:
+            chain = [cluster for start, length in node.extents for cluster in range(start, start + length)]
+            for cluster, next_cluster in zip(chain, chain[1:]):
+                fat[cluster] = next_cluster
+            if chain:
+                fat[chain[-1]] = FAT_ENTRY_MASK
+        if sys.byteorder == 'big':
+            fat.byteswap()
+        return fat
+
+    def _cluster_offset(self, cluster: int) -> int:
+        data_start = (RESERVED_SECTORS + NUM_FATS * self._fat_size) * BYTES_PER_SECTOR
+        return data_start + (cluster - MIN_VALID_INDEX) * self.spec.cluster_size
+
+    def _write_boot_sectors(self, image: DiskImage) -> None:
+        boot_sector = bytearray(BYTES_PER_SECTOR)
+        boot_sector[0:11] = b"\xEB\x58\x90MSWIN4.1"
+        struct.pack_into("<HBHBHHBHHHII", boot_sector, 11, BYTES_PER_SECTOR, self._sectors_per_cluster,
+                         RESERVED_SECTORS, NUM_FATS, 0, 0, MEDIA_DESCRIPTOR, 0, 63, 255, 0, self._total_sectors)
+        struct.pack_into("<IHHIHH", boot_sector, 36, self._fat_size, 0, 0, MIN_VALID_INDEX,
+                         FS_INFO_SECTOR, BACKUP_BOOT_SECTOR)
+        boot_sector[66] = 0x29
+        boot_sector[71:90] = b"NO NAME    FAT32   "
+        boot_sector[510:512] = b"\x55\xAA"
+
+        free_count = self.total_clusters - sum(node.clusters_count for node in self._nodes)
+        fs_info = bytearray(BYTES_PER_SECTOR)
+        struct.pack_into("<I", fs_info, 0, FSINFO_LEAD_SIG)
+        struct.pack_into("<IIII", fs_info, 484, FSINFO_STRUC_SIG, free_count, MIN_VALID_INDEX, 0)
+        fs_info[510:512] = b"\x55\xAA"
+
+        for sector in (0, BACKUP_BOOT_SECTOR):
+            image.write(sector * BYTES_PER_SECTOR, boot_sector)
+            image.write((sector + FS_INFO_SECTOR) * BYTES_PER_SECTOR, fs_info)
+
+    def _write_fats(self, image: DiskImage, fat: array) -> None:
+        fat_data = fat.tobytes()
+        for fat_number in range(NUM_FATS):
+            image.write((RESERVED_SECTORS + fat_number * self._fat_size) * BYTES_PER_SECTOR, fat_data)
+
+    def _write_directories(self, image: DiskImage) -> None:
+        """
+        Записывает содержимое каталогов: '.', '..', LFN-записи, короткие записи и удалённые записи
+        """
+        for node in self._nodes:
+            if not node.is_directory:
+                continue
+            data = bytearray()
+            if node.parent is not None:
+                parent_start = 0 if node.parent == 0 else self._nodes[node.parent].extents[0][0]
+                data += self._short_entry(b".          ", FatAttributes.DIRECTORY, node.extents[0][0], 0)
+                data += self._short_entry(b"..         ", FatAttributes.DIRECTORY, parent_start, 0)
+            for child_id in node.children:
+                child = self._nodes[child_id]
+                if child.deleted_before:
+                    data += bytes([DELETED_ENTRY_MARK]) + self._short_entry(
+                        b"DELETED TMP", FatAttributes.ARCHIVE, 0, 0)[1:]
+                if child.long_name is not None:
+                    data += self._lfn_entries(child.long_name, child.short_name)
+                attributes = FatAttributes.DIRECTORY if child.is_directory else FatAttributes.ARCHIVE
+                start = child.extents[0][0] if child.extents else 0
+                data += self._short_entry(child.short_name, attributes, start, 0 if child.is_directory else child.size)
+
+            position = 0
+            for start, length in node.extents:
+                piece = data[position:position + length * self.spec.cluster_size]
+                image.write(self._cluster_offset(start), piece)
+                position += length * self.spec.cluster_size
+
+    def _write_file_markers(self, image: DiskImage) -> None:
+        for node_id, node in enumerate(self._nodes):
+            if node.is_directory:
+                continue
+            cluster_number = 0
+            for start, length in node.extents:
+                for cluster in range(start, start + length):
+                    image.write(self._cluster_offset(cluster), CLUSTER_MARKER.pack(node_id, cluster_number))
+                    cluster_number += 1
+
+    def _short_entry(self, short_name: bytes, attributes: int, start: int, size: int) -> bytes:
+        return (short_name + bytes([attributes, 0]) + bytes(7) + struct.pack("<H", start >> 16) + bytes(4)
+                + struct.pack("<HI", start & 0xFFFF, size))
+
+    def _lfn_entries(self, long_name: str, short_name: bytes) -> bytes:
+        """
+        Кодирует длинное имя в LFN-записи, которые идут в каталоге в обратном порядке
+        """
+        checksum = 0
+        for byte in short_name:
+            checksum = (((checksum & 1) << 7) + (checksum >> 1) + byte) & 0xFF
+
+        name = long_name.encode('utf-16le') + b"\x00\x00"
+        parts_count = -(-len(long_name) // LFN_CHARS_PER_ENTRY)
+        name = name[:parts_count * LFN_CHARS_PER_ENTRY * 2].ljust(parts_count * LFN_CHARS_PER_ENTRY * 2, b"\xFF")
+        entries = []
+        for part in range(parts_count):
+            chunk = name[part * LFN_CHARS_PER_ENTRY * 2:(part + 1) * LFN_CHARS_PER_ENTRY * 2]
+            order = (part + 1) | (LFN_LAST_ENTRY_FLAG if part == parts_count - 1 else 0)
+            entries.append(bytes([order]) + chunk[0:10] + bytes([FatAttributes.LONG_NAME, 0, checksum])
+                           + chunk[10:22] + bytes(2) + chunk[22:26])
+        return b"".join(reversed(entries))
+
+def find_corrupted_files(fat_reader: FatReader, directory_parser: DirectoryParser) -> list[str]:
+    """
+    Сверяет метки в начале кластеров файлов сгенерированного образа с порядком их цепочек
+    и возвращает пути файлов, у которых метки не совпали
+    """
+    corrupted: list[str] = []
+    for file in directory_parser.iter_files(fat_reader.bpb.root_clus):
+        file_id = None
+        for cluster_number, cluster in enumerate(fat_reader.get_cluster_chain(file.starting_cluster)):
+            marker_file_id, marker_number = CLUSTER_MARKER.unpack(fat_reader.read_cluster_data(cluster)[:CLUSTER_MARKER.size])
+            if file_id is None:
+                file_id = marker_file_id
+            if marker_file_id != file_id or marker_number != cluster_number:
+                corrupted.append(file.path)
+                break
+    return corrupted
+
+arg_parser = argparse.ArgumentParser()
+arg_parser.add_argument("image_path", type=str)
+arg_parser.add_argument("--volume-size", type=int, default=ImageSpec.volume_size)
+arg_parser.add_argument("--cluster-size", type=int, default=ImageSpec.cluster_size)
+arg_parser.add_argument("--files", type=int, default=ImageSpec.files)
+arg_parser.add_argument("--directories", type=int, default=ImageSpec.directories)
+arg_parser.add_argument("--max-depth", type=int, default=ImageSpec.max_depth)
+arg_parser.add_argument("--lfn-density", type=float, default=ImageSpec.lfn_density)
+arg_parser.add_argument("--fragmentation", type=float, default=ImageSpec.fragmentation)
+arg_parser.add_argument("--max-file-clusters", type=int, default=ImageSpec.max_file_clusters)
+arg_parser.add_argument("--seed", type=int, default=ImageSpec.seed)
+
+if __name__ == "__main__":
+    args = arg_parser.parse_args()
+    spec = ImageSpec(
+        volume_size=args.volume_size,
+        cluster_size=args.cluster_size,
+        files=args.files,
+        directories=args.directories,
+        max_depth=args.max_depth,
+        lfn_density=args.lfn_density,
+        fragmentation=args.fragmentation,
+        max_file_clusters=args.max_file_clusters,
+        seed=args.seed,
+    )
+    summary = ImageGenerator(spec).generate(Path(args.image_path))
+    print(f"Образ создан: {args.image_path}")
+    for key, value in summary.items():
+        print(f"  {key}: {value}")
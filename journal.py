@@ -0,0 +1,78 @@
+import json
+import logging
+import os
+from pathlib import Path
+
+from free_space import chain_to_runs, runs_to_chain
+
+STATE_STARTED = "started"
+STATE_COPIED = "copied"
+
+logger = logging.getLogger(__name__)
+
+class RelocationJournal:
+    """
+    Журнал упреждающей записи для перемещения файлов на месте. В каждый момент хранит не больше
+    одной незавершённой записи: старую и новую цепочки, смещение записи каталога (None для корня)
+    и прежнее значение последней записи FAT старой цепочки.
+    """
+    def __init__(self, journal_path: Path) -> None:
+        self.journal_path = Path(journal_path)
+        self._record: dict | None = None
+
+    def begin(self, path: str, entry_offset: int | None, old_chain: list[int], new_chain: list[int],
+              old_chain_end: int, is_directory: bool = False) -> None:
+        """
+        Записывает на диск начало перемещения до любой записи в образ
+        """
+        self._record = {
+            "state": STATE_STARTED,
+            "path": path,
+            "entry_offset": entry_offset,
+            "old_chain": chain_to_runs(old_chain),
+            "new_chain": chain_to_runs(new_chain),
+            "old_chain_end": old_chain_end,
+            "is_directory": is_directory,
+        }
+        self._write()
+
+    def mark_copied(self) -> None:
+        """
+        Отмечает, что данные полностью скопированы в новые кластеры
+        """
+        if self._record is None:
+            raise RuntimeError("Нет активной записи журнала.")
+        self._record["state"] = STATE_COPIED
+        self._write()
+
+    def commit(self) -> None:
+        """
+        Завершает перемещение, удаляя запись журнала
+        """
+        self._record = None
+        self.journal_path.unlink(missing_ok=True)
+
+    def load(self) -> dict | None:
+        """
+        Читает незавершённую запись, оставшуюся после прерванного запуска
+        """
+        if not self.journal_path.exists():
+            return None
+        try:
+            with open(self.journal_path, 'r', encoding='utf-8') as journal_file:
+                record = json.load(journal_file)
+        except (OSError, ValueError):
+            logger.warning("Журнал '%s' повреждён и будет проигнорирован.", self.journal_path)
+            return None
+        record["old_chain"] = runs_to_chain(record["old_chain"])
+        record["new_chain"] = runs_to_chain(record["new_chain"])
+        record.setdefault("is_directory", False)
+        return record
+
+    def _write(self) -> None:
+        temporary_path = self.journal_path.with_name(f"{self.journal_path.name}.tmp")
+        with open(temporary_path, 'w', encoding='utf-8') as journal_file:
+            json.dump(self._record, journal_file)
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        os.replace(temporary_path, self.journal_path)
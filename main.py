@@ -1,23 +1,127 @@
-import shutil
 import argparse
+import contextlib
+import logging
 from pathlib import Path
 
 from bpb import BPB
+from disk_image import DiskImage, IoThrottle, copy_image
 from directory_parser import DirectoryParser
-from fat_reader import FatReader
-from defragmenter import Defragmenter
+from fat_reader import DEFAULT_METADATA_CACHE_SIZE, FatReader
+from defragmenter import Defragmenter, DEFAULT_COPY_BUFFER_SIZE
+from journal import RelocationJournal
+from planner import FILE_ORDER_EXTENSION, FILE_ORDER_SIZE, FILE_ORDER_TRAVERSAL, PLACEMENT_BEST_FIT, PLACEMENT_LOCALITY, MovePlan
+from progress import DEFAULT_REPORT_INTERVAL, ProgressTracker, profiling
 
-arg_parser = argparse.ArgumentParser()
+options_parser = argparse.ArgumentParser(add_help=False)
+options_parser.add_argument("--copy-buffer-size", type=int, default=DEFAULT_COPY_BUFFER_SIZE)
+options_parser.add_argument("--metadata-cache-size", type=int, default=DEFAULT_METADATA_CACHE_SIZE)
+options_parser.add_argument("--analyze", "--dry-run", dest="analyze", action="store_true")
+options_parser.add_argument("--in-place", action="store_true")
+options_parser.add_argument("--skip-directories", action="store_true")
+options_parser.add_argument("--compact-directories", action="store_true")
+options_parser.add_argument("--placement", choices=[PLACEMENT_BEST_FIT, PLACEMENT_LOCALITY], default=PLACEMENT_BEST_FIT)
+options_parser.add_argument("--file-order", choices=[FILE_ORDER_TRAVERSAL, FILE_ORDER_SIZE, FILE_ORDER_EXTENSION],
+                            default=FILE_ORDER_TRAVERSAL)
+options_parser.add_argument("--stream", action="store_true")
+options_parser.add_argument("--save-plan", type=str, default=None)
+options_parser.add_argument("--plan", type=str, default=None)
+options_parser.add_argument("--snapshot", type=str, default=None)
+options_parser.add_argument("--log-level", choices=["DEBUG", "INFO", "WARNING", "ERROR"], default="INFO")
+options_parser.add_argument("--progress-interval", type=float, default=DEFAULT_REPORT_INTERVAL)
+options_parser.add_argument("--progress-json", type=str, default=None)
+options_parser.add_argument("--profile", type=str, default=None)
+options_parser.add_argument("--trace-memory", action="store_true")
+
+arg_parser = argparse.ArgumentParser(parents=[options_parser])
 arg_parser.add_argument("image_path", type=str)
 
+def print_analysis_report(report: dict) -> None:
+    """
+    Выводит отчёт о фрагментации образа
+    """
+    print(f"Файлов: {report['files']}")
+    print(f"Фрагментированных файлов: {report['fragmented_files']} (фрагментов: {report['fragments']})")
+    print(f"Фрагментированных каталогов: {report['fragmented_directories']}")
+    print(f"Свободных кластеров: {report['free_clusters']}")
+    census = report["census"]
+    print(f"Кластеров в томе: {census['total_clusters']}, занято: {census['used_clusters']}, "
+          f"свободно: {census['free_clusters']}")
+    print(f"Свободных экстентов: {census['free_extents']}, самый длинный: {census['largest_free_extent']} кл.")
+    print(f"Разрывов цепочек (next != index + 1): {census['fragmented_links']}")
+    print("Гистограмма свободных экстентов (длина в кластерах: количество):")
+    for bucket, count in report["free_extents_histogram"].items():
+        print(f"  {bucket}: {count}")
+    print("Запланированные перемещения:")
+    for move in report["moves"]:
+        print(f"  {move['path']}: {move['fragments']} фрагм., {move['clusters_count']} кл., "
+              f"{move['bytes']} байт -> кластер {move['new_start']}")
+    for path in report["unplaceable_files"]:
+        print(f"  {path}: не удалось найти подходящий блок")
+    print(f"Всего к перемещению: {report['clusters_to_move']} кластеров, {report['bytes_to_move']} байт")
+
+def process_image(image_path: Path, args: argparse.Namespace, throttle: IoThrottle | None = None,
+                  print_report: bool = True) -> dict:
+    """
+    Анализирует или дефрагментирует один образ с заданными опциями и возвращает сводку: число файлов,
+    фрагментированных файлов, запланированных и выполненных перемещений. При throttle копирование
+    образа и перенос данных ограничиваются по скорости.
+    """
+    journal = None
+    if args.analyze:
+        target_image_path = image_path
+    elif args.in_place:
+        target_image_path = image_path
+        journal = RelocationJournal(image_path.with_name(f"{image_path.name}.journal"))
+    else:
+        target_image_path = image_path.with_name(f"{image_path.name}_defragmented")
+        copy_image(image_path, target_image_path, throttle)
+
+    summary: dict = {"image": str(image_path), "output": str(target_image_path)}
+    with contextlib.ExitStack() as stack:
+        progress_json = open(args.progress_json, 'w', encoding='utf-8') if args.progress_json else None
+        if progress_json is not None:
+            stack.enter_context(progress_json)
+        stack.enter_context(profiling(Path(args.profile) if args.profile else None, args.trace_memory))
+        image = stack.enter_context(DiskImage(target_image_path, writable=not args.analyze, throttle=throttle))
+
+        bpb = BPB(image)
+        fat_reader = FatReader(image, bpb, args.metadata_cache_size)
+        parser = DirectoryParser(fat_reader)
+        progress = ProgressTracker(progress_json, args.progress_interval)
+        defragmenter = Defragmenter(image, fat_reader, parser,
+                                    copy_buffer_size=args.copy_buffer_size,
+                                    journal=journal,
+                                    defragment_directories=not args.skip_directories,
+                                    compact_directories=args.compact_directories,
+                                    placement=args.placement,
+                                    file_order=args.file_order,
+                                    progress=progress,
+                                    snapshot_path=Path(args.snapshot) if args.snapshot else None)
+        if args.stream and not args.analyze:
+            defragmenter.defragment_streaming()
+        else:
+            plan = MovePlan.load(Path(args.plan)) if args.plan else defragmenter.plan()
+            if args.save_plan:
+                plan.save(Path(args.save_plan))
+            summary.update(files=plan.files, fragmented_files=plan.fragmented_files,
+                           fragmented_directories=plan.fragmented_directories, planned_moves=len(plan.moves),
+                           bytes_to_move=plan.bytes_to_move, unplaceable_files=len(plan.unplaceable_files))
+            if args.analyze:
+                report = defragmenter.analyze(plan)
+                summary["free_clusters"] = report["free_clusters"]
+                summary["fragmented_links"] = report["census"]["fragmented_links"]
+                if print_report:
+                    print_analysis_report(report)
+            else:
+                defragmenter.defragment(plan)
+        if not args.analyze:
+            summary.update(files_moved=progress.files_moved, clusters_moved=progress.clusters_moved,
+                           bytes_moved=progress.bytes_moved)
+        summary.update(metadata_cache_hits=fat_reader.metadata_cache.hits,
+                       metadata_cache_misses=fat_reader.metadata_cache.misses)
+    return summary
+
 if __name__ == "__main__":
     args = arg_parser.parse_args()
-    image_path = Path(args.image_path)
-    final_image_path = image_path.with_name(f"{image_path.name}_defragmented")
-
-    shutil.copyfile(image_path, final_image_path)
-    bpb = BPB(final_image_path)
-    fat_reader = FatReader(final_image_path, bpb)
-    parser = DirectoryParser(fat_reader)
-    defragmenter = Defragmenter(image_path, fat_reader, parser)
-    defragmenter.defragment()
+    logging.basicConfig(level=args.log_level, format="%(message)s")
+    process_image(Path(args.image_path), args)
@@ -0,0 +1,436 @@
+import json
+from array import array
+from collections.abc import Sequence
+from dataclasses import asdict, dataclass, field
+from pathlib import Path, PurePosixPath
+
+from fat_analysis import count_fragments
+from fat_reader import MIN_VALID_INDEX, FatReader
+from free_space import FreeExtent, FreeExtentIndex, group_runs
+
+PLACEMENT_BEST_FIT = "best-fit"
+PLACEMENT_LOCALITY = "locality"
+FILE_ORDER_TRAVERSAL = "traversal"
+FILE_ORDER_SIZE = "size"
+FILE_ORDER_EXTENSION = "extension"
+
+FREE_OWNER = -1
+IMMOVABLE_OWNER = -2
+RESERVED_OWNER = -3
+
+@dataclass
+class PlannedMove:
+    path: str
+    entry_offset: int | None
+    old_start: int
+    clusters_count: int
+    kept_clusters: int
+    new_start: int
+    fragments: int
+    bytes: int
+    is_directory: bool = False
+    compact: bool = False
+    new_clusters_count: int | None = None
+
+    @property
+    def moved_clusters(self) -> int:
+        new_clusters_count = self.clusters_count if self.new_clusters_count is None else self.new_clusters_count
+        return new_clusters_count - self.kept_clusters
+
+    def new_chain(self, old_chain: list[int]) -> list[int]:
+        """
+        Строит новую цепочку: первые kept_clusters кластеров остаются на месте, остальные идут подряд с new_start
+        """
+        return old_chain[:self.kept_clusters] + list(range(self.new_start, self.new_start + self.moved_clusters))
+
+@dataclass
+class MovePlan:
+    cluster_size: int
+    files: int = 0
+    fragmented_files: int = 0
+    fragmented_directories: int = 0
+    fragments: int = 0
+    moves: list[PlannedMove] = field(default_factory=list)
+    unplaceable_files: list[str] = field(default_factory=list)
+
+    @property
+    def clusters_to_move(self) -> int:
+        return sum(move.moved_clusters for move in self.moves)
+
+    @property
+    def bytes_to_move(self) -> int:
+        return sum(move.bytes for move in self.moves)
+
+    def to_dict(self) -> dict:
+        plan = asdict(self)
+        plan["clusters_to_move"] = self.clusters_to_move
+        plan["bytes_to_move"] = self.bytes_to_move
+        return plan
+
+    @classmethod
+    def from_dict(cls, plan: dict) -> "MovePlan":
+        return cls(
+            cluster_size=plan["cluster_size"],
+            files=plan["files"],
+            fragmented_files=plan["fragmented_files"],
+            fragmented_directories=plan.get("fragmented_directories", 0),
+            fragments=plan["fragments"],
+            moves=[PlannedMove(**move) for move in plan["moves"]],
+            unplaceable_files=list(plan["unplaceable_files"]),
+        )
+
+    def save(self, plan_path: Path) -> None:
+        """
+        Сохраняет план в JSON для просмотра или последующего выполнения
+        """
+        with open(plan_path, 'w', encoding='utf-8') as plan_file:
+            json.dump(self.to_dict(), plan_file, ensure_ascii=False, indent=2)
+
+    @classmethod
+    def load(cls, plan_path: Path) -> "MovePlan":
+        with open(plan_path, 'r', encoding='utf-8') as plan_file:
+            return cls.from_dict(json.load(plan_file))
+
+class MovePlanner:
+    """
+    Строит глобальный план перемещений до любых операций ввода-вывода. Сначала переносятся мелкие файлы,
+    освобождённое ими место сразу возвращается в индекс и достаётся крупным. Файлы, для которых места
+    не нашлось, повторяются, пока план продолжает расти. Если за первым фрагментом файла достаточно
+    свободного места, первый фрагмент остаётся на месте и переносится только хвост.
+    Каталоги переносятся после всех файлов, от самых глубоких к корню, чтобы сохранённые смещения
+    записей в родительских каталогах оставались верными до момента их использования.
+    """
+    def __init__(self, fat_reader: FatReader, free_blocks: list[FreeExtent]) -> None:
+        self._fat_reader = fat_reader
+        self._free_space = FreeExtentIndex(free_blocks)
+
+    def plan(self, all_files: list[dict], all_directories: list[dict] | None = None) -> MovePlan:
+        plan = MovePlan(cluster_size=self._fat_reader.cluster_size, files=len(all_files))
+        pending: list[tuple[dict, list[int], int]] = []
+
+        for file in all_files:
+            cluster_chain = self._fat_reader.get_cluster_chain(file["starting_cluster"])
+            fragments = count_fragments(cluster_chain)
+            if fragments > 1:
+                plan.fragmented_files += 1
+                plan.fragments += fragments
+                pending.append((file, cluster_chain, fragments))
+
+        pending.sort(key=lambda candidate: len(candidate[1]))
+        while pending:
+            deferred = []
+            for file, cluster_chain, fragments in pending:
+                move = self.plan_file(file["path"], file["entry_offset"], cluster_chain, fragments)
+                if move is None:
+                    deferred.append((file, cluster_chain, fragments))
+                else:
+                    plan.moves.append(move)
+            if len(deferred) == len(pending):
+                break
+            pending = deferred
+
+        plan.unplaceable_files = [file["path"] for file, _, _ in pending]
+
+        deepest_first = sorted(all_directories or [], key=lambda directory: (
+            directory["entry_offset"] is None, -directory["path"].count("/")
+        ))
+        for directory in deepest_first:
+            move = self._plan_directory(plan, directory)
+            if move is not None:
+                plan.moves.append(move)
+        return plan
+
+    def _plan_directory(self, plan: MovePlan, directory: dict) -> PlannedMove | None:
+        """
+        Планирует перенос каталога, если его цепочка фрагментирована, а при сжатии - ещё и если
+        в нём есть удалённые записи. Каталог всегда переносится целиком.
+        """
+        cluster_chain = self._fat_reader.get_cluster_chain(directory["starting_cluster"])
+        if not cluster_chain:
+            return None
+        fragments = count_fragments(cluster_chain)
+        new_clusters_count = directory.get("compacted_clusters", len(cluster_chain))
+        if fragments <= 1 and new_clusters_count >= len(cluster_chain) and not directory.get("deleted_entries"):
+            return None
+
+        if fragments > 1:
+            plan.fragmented_directories += 1
+        best_fit = self._free_space.find_best_fit(new_clusters_count)
+        if best_fit is None:
+            plan.unplaceable_files.append(directory["path"] or "/")
+            return None
+
+        new_start, _ = best_fit
+        self._free_space.allocate(new_start, new_clusters_count)
+        self._free_space.free_clusters(cluster_chain)
+        return PlannedMove(
+            path=directory["path"] or "/",
+            entry_offset=directory["entry_offset"],
+            old_start=cluster_chain[0],
+            clusters_count=len(cluster_chain),
+            kept_clusters=0,
+            new_start=new_start,
+            fragments=fragments,
+            bytes=new_clusters_count * self._fat_reader.cluster_size,
+            is_directory=True,
+            compact=directory.get("compact", False),
+            new_clusters_count=new_clusters_count,
+        )
+
+    def plan_file(self, path: str, entry_offset: int, cluster_chain: list[int], fragments: int) -> PlannedMove | None:
+        """
+        Подбирает место для файла и резервирует его в индексе свободного места
+        """
+        clusters_count = len(cluster_chain)
+        kept_clusters = self._first_run_length(cluster_chain)
+        tail_start = cluster_chain[0] + kept_clusters
+
+        if self._free_space.length_at(tail_start) >= clusters_count - kept_clusters:
+            new_start = tail_start
+        else:
+            best_fit = self._free_space.find_best_fit(clusters_count)
+            if best_fit is None:
+                return None
+            new_start, _ = best_fit
+            kept_clusters = 0
+
+        self._free_space.allocate(new_start, clusters_count - kept_clusters)
+        self._free_space.free_clusters(cluster_chain[kept_clusters:])
+        return PlannedMove(
+            path=path,
+            entry_offset=entry_offset,
+            old_start=cluster_chain[0],
+            clusters_count=clusters_count,
+            kept_clusters=kept_clusters,
+            new_start=new_start,
+            fragments=fragments,
+            bytes=(clusters_count - kept_clusters) * self._fat_reader.cluster_size,
+        )
+
+    def _first_run_length(self, cluster_chain: list[int]) -> int:
+        length = 1
+        while length < len(cluster_chain) and cluster_chain[length] == cluster_chain[0] + length:
+            length += 1
+        return length
+
+class LayoutPlanner:
+    """
+    План полной упаковки тома с учётом локальности: для каждого каталога в порядке обхода
+    подряд с начала области данных размещаются его цепочка и затем его файлы. Объекты, занимающие
+    целевой диапазон, сначала вытесняются в конец свободного места, занятые кластеры без
+    владельца (потерянные цепочки, сбойные кластеры) обходятся. В результате свободное место
+    собирается в один экстент в конце тома.
+    """
+    def __init__(self, fat_reader: FatReader, free_blocks: list[FreeExtent],
+                 file_order: str = FILE_ORDER_TRAVERSAL, move_directories: bool = True) -> None:
+        self._fat_reader = fat_reader
+        self._free_space = FreeExtentIndex(free_blocks)
+        self._file_order = file_order
+        self._move_directories = move_directories
+        self._owners = array('i', [IMMOVABLE_OWNER]) * fat_reader.total_clusters
+        for start, length in free_blocks:
+            self._owners[start:start + length] = array('i', [FREE_OWNER]) * length
+        self._objects: list[tuple[dict, bool]] = []
+        self._chains: list[Sequence[int]] = []
+        self._parents: list[int | None] = []
+        self._entry_positions: list[tuple[int, int]] = []
+
+    def plan(self, all_files: list[dict], all_directories: list[dict]) -> MovePlan:
+        plan = MovePlan(cluster_size=self._fat_reader.cluster_size, files=len(all_files))
+        self._register_objects(plan, all_files, all_directories)
+
+        cursor = MIN_VALID_INDEX
+        for object_id, (record, _) in enumerate(self._objects):
+            clusters_count = len(self._chains[object_id])
+            if clusters_count == 0:
+                continue
+            target_start = self._skip_immovable(cursor, clusters_count)
+            if target_start is None:
+                plan.unplaceable_files.extend(self._unplaced_fragmented(object_id))
+                break
+            if not self._is_placed_at(object_id, target_start):
+                if not self._clear_range(plan, target_start, clusters_count):
+                    plan.unplaceable_files.extend(self._unplaced_fragmented(object_id))
+                    break
+                self._relocate(plan, object_id, target_start)
+            cursor = target_start + clusters_count
+        return plan
+
+    def _layout_order(self, all_files: list[dict], all_directories: list[dict]) -> list[tuple[dict, bool]]:
+        """
+        Порядок размещения: каталог, затем его файлы; каталоги - в порядке обхода дерева
+        """
+        files_by_parent: dict[int, list[dict]] = {}
+        for file in all_files:
+            files_by_parent.setdefault(file["parent_cluster"], []).append(file)
+
+        objects: list[tuple[dict, bool]] = []
+        for directory in all_directories:
+            objects.append((directory, True))
+            objects.extend((file, False) for file in self._order_files(files_by_parent.pop(directory["starting_cluster"], [])))
+        for files in files_by_parent.values():
+            objects.extend((file, False) for file in files)
+        return objects
+
+    def _order_files(self, files: list[dict]) -> list[dict]:
+        """
+        Упорядочивает файлы каталога: по обходу, по размеру (мелкие первыми) или по расширению
+        """
+        if self._file_order == FILE_ORDER_SIZE:
+            return sorted(files, key=lambda file: file["size"])
+        if self._file_order == FILE_ORDER_EXTENSION:
+            return sorted(files, key=lambda file: PurePosixPath(file["path"]).suffix.lower())
+        return files
+
+    def _register_objects(self, plan: MovePlan, all_files: list[dict], all_directories: list[dict]) -> None:
+        """
+        Читает цепочки всех объектов, отмечает владельцев кластеров и позиции записей каталога
+        """
+        directory_chains: dict[int, list[int]] = {}
+        for directory in all_directories:
+            directory_chains[directory["starting_cluster"]] = self._fat_reader.get_cluster_chain(directory["starting_cluster"])
+
+        object_by_cluster: dict[int, int] = {}
+        for record, is_directory in self._layout_order(all_files, all_directories):
+            if is_directory:
+                cluster_chain = directory_chains[record["starting_cluster"]]
+            else:
+                cluster_chain = self._fat_reader.get_cluster_chain(record["starting_cluster"])
+            fragments = count_fragments(cluster_chain)
+            if fragments > 1:
+                if is_directory:
+                    plan.fragmented_directories += 1
+                else:
+                    plan.fragmented_files += 1
+                    plan.fragments += fragments
+            if is_directory and not self._move_directories:
+                continue
+
+            object_id = len(self._objects)
+            if is_directory:
+                object_by_cluster[record["starting_cluster"]] = object_id
+            self._objects.append((record, is_directory))
+            self._chains.append(cluster_chain)
+            for cluster in cluster_chain:
+                if cluster < len(self._owners):
+                    self._owners[cluster] = object_id
+
+        data_start = self._fat_reader.get_cluster_offset(MIN_VALID_INDEX)
+        cluster_size = self._fat_reader.cluster_size
+        for record, _ in self._objects:
+            parent_id = object_by_cluster.get(record["parent_cluster"])
+            self._parents.append(parent_id)
+            if parent_id is None:
+                self._entry_positions.append((0, 0))
+                continue
+            entry_cluster = (record["entry_offset"] - data_start) // cluster_size + MIN_VALID_INDEX
+            self._entry_positions.append((
+                directory_chains[record["parent_cluster"]].index(entry_cluster),
+                (record["entry_offset"] - data_start) % cluster_size,
+            ))
+
+    def _entry_offset(self, object_id: int) -> int | None:
+        """
+        Вычисляет смещение записи объекта с учётом уже запланированных перемещений его родительского каталога
+        """
+        record, _ = self._objects[object_id]
+        parent_id = self._parents[object_id]
+        if parent_id is None:
+            return record["entry_offset"]
+        chain_position, offset_in_cluster = self._entry_positions[object_id]
+        return self._fat_reader.get_cluster_offset(self._chains[parent_id][chain_position]) + offset_in_cluster
+
+    def _skip_immovable(self, start: int, clusters_count: int) -> int | None:
+        """
+        Сдвигает начало целевого диапазона за занятые кластеры без владельца
+        """
+        position = start
+        while position < start + clusters_count:
+            if position >= len(self._owners):
+                return None
+            if self._owners[position] == IMMOVABLE_OWNER:
+                start = position + 1
+            position += 1
+        return start
+
+    def _clear_range(self, plan: MovePlan, start: int, clusters_count: int) -> bool:
+        """
+        Резервирует свободную часть диапазона и вытесняет из него все объекты, включая размещаемый
+        """
+        target = range(start, start + clusters_count)
+        occupants: dict[int, None] = {}
+        free_clusters: list[int] = []
+        for cluster in target:
+            owner = self._owners[cluster]
+            if owner == FREE_OWNER:
+                free_clusters.append(cluster)
+            elif owner >= 0:
+                occupants[owner] = None
+
+        for run_start, run_length in group_runs(free_clusters):
+            self._free_space.allocate(run_start, run_length)
+        for cluster in free_clusters:
+            self._owners[cluster] = RESERVED_OWNER
+
+        for object_id in occupants:
+            clusters_count = len(self._chains[object_id])
+            last_fit = self._free_space.find_last_fit(clusters_count)
+            if last_fit is None:
+                released = [cluster for cluster in target if self._owners[cluster] == RESERVED_OWNER]
+                for cluster in released:
+                    self._owners[cluster] = FREE_OWNER
+                self._free_space.free_clusters(released)
+                return False
+            eviction_start = last_fit[0] + last_fit[1] - clusters_count
+            self._free_space.allocate(eviction_start, clusters_count)
+            self._relocate(plan, object_id, eviction_start, target)
+        return True
+
+    def _is_placed_at(self, object_id: int, start: int) -> bool:
+        cluster_chain = self._chains[object_id]
+        return cluster_chain[0] == start and count_fragments(cluster_chain) == 1
+
+    def _relocate(self, plan: MovePlan, object_id: int, new_start: int, reserved: range = range(0)) -> None:
+        """
+        Добавляет в план перенос объекта целиком в [new_start, new_start + n). Место под новый диапазон
+        уже должно быть зарезервировано; старые кластеры внутри reserved остаются зарезервированными.
+        """
+        record, is_directory = self._objects[object_id]
+        old_chain = self._chains[object_id]
+        clusters_count = len(old_chain)
+        plan.moves.append(PlannedMove(
+            path=record["path"] or "/",
+            entry_offset=self._entry_offset(object_id),
+            old_start=old_chain[0],
+            clusters_count=clusters_count,
+            kept_clusters=0,
+            new_start=new_start,
+            fragments=count_fragments(old_chain),
+            bytes=clusters_count * self._fat_reader.cluster_size,
+            is_directory=is_directory,
+            new_clusters_count=clusters_count,
+        ))
+
+        released: list[int] = []
+        for cluster in old_chain:
+            if cluster in reserved:
+                self._owners[cluster] = RESERVED_OWNER
+            else:
+                self._owners[cluster] = FREE_OWNER
+                released.append(cluster)
+        self._free_space.free_clusters(released)
+
+        new_chain = range(new_start, new_start + clusters_count)
+        for cluster in new_chain:
+            self._owners[cluster] = object_id
+        self._chains[object_id] = new_chain
+
+    def _unplaced_fragmented(self, first_object_id: int) -> list[str]:
+        """
+        Возвращает пути фрагментированных объектов, до которых упаковка не дошла
+        """
+        return [
+            record["path"] or "/"
+            for (record, _), cluster_chain in zip(self._objects[first_object_id:], self._chains[first_object_id:])
+            if count_fragments(cluster_chain) > 1
+        ]
@@ -0,0 +1,139 @@
+import cProfile
+import contextlib
+import json
+import logging
+import time
+import tracemalloc
+from collections.abc import Iterator
+from pathlib import Path
+from typing import IO
+
+logger = logging.getLogger(__name__)
+
+MEGABYTE = 1024 * 1024
+DEFAULT_REPORT_INTERVAL = 1.0
+TRACEMALLOC_TOP_LINES = 10
+
+class ProgressTracker:
+    """
+    Счётчики и таймеры дефрагментации: перемещённые файлы, кластеры и байты, скорость, оценка
+    оставшегося времени и длительность фаз. Прогресс пишется в журнал не чаще раза в interval секунд,
+    а при заданном json_stream каждое событие дублируется в него строкой JSON.
+    """
+    def __init__(self, json_stream: IO[str] | None = None, interval: float = DEFAULT_REPORT_INTERVAL) -> None:
+        self.json_stream = json_stream
+        self.interval = interval
+        self.files_total: int | None = None
+        self.bytes_total: int | None = None
+        self.files_moved = 0
+        self.clusters_moved = 0
+        self.bytes_moved = 0
+        self.phase_seconds: dict[str, float] = {}
+        self._started = time.perf_counter()
+        self._last_report = self._started
+
+    def start(self, files_total: int | None = None, bytes_total: int | None = None) -> None:
+        """
+        Сбрасывает счётчики перед переносом; без известного объёма работы ETA не считается
+        """
+        self.files_total = files_total
+        self.bytes_total = bytes_total
+        self.files_moved = 0
+        self.clusters_moved = 0
+        self.bytes_moved = 0
+        self._started = time.perf_counter()
+        self._last_report = self._started
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """
+        Замеряет длительность фазы; повторные фазы с тем же именем суммируются
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started
+            self.phase_seconds[name] = self.phase_seconds.get(name, 0.0) + seconds
+            logger.info("Фаза '%s': %.3f с", name, seconds)
+            self._emit({"event": "phase", "phase": name, "seconds": seconds})
+
+    def record_move(self, clusters_count: int, bytes_count: int) -> None:
+        self.files_moved += 1
+        self.clusters_moved += clusters_count
+        self.bytes_moved += bytes_count
+        now = time.perf_counter()
+        if now - self._last_report >= self.interval:
+            self._last_report = now
+            self.report()
+
+    def snapshot(self) -> dict:
+        """
+        Текущее состояние счётчиков, скорость и оценка оставшегося времени в секундах
+        """
+        elapsed = time.perf_counter() - self._started
+        files_per_second = self.files_moved / elapsed if elapsed else 0.0
+        bytes_per_second = self.bytes_moved / elapsed if elapsed else 0.0
+        eta = None
+        if self.bytes_total is not None and bytes_per_second:
+            eta = max(0.0, (self.bytes_total - self.bytes_moved) / bytes_per_second)
+        elif self.files_total is not None and files_per_second:
+            eta = max(0.0, (self.files_total - self.files_moved) / files_per_second)
+        return {
+            "elapsed": elapsed,
+            "files_moved": self.files_moved,
+            "files_total": self.files_total,
+            "clusters_moved": self.clusters_moved,
+            "bytes_moved": self.bytes_moved,
+            "bytes_total": self.bytes_total,
+            "files_per_second": files_per_second,
+            "mb_per_second": bytes_per_second / MEGABYTE,
+            "eta": eta,
+        }
+
+    def report(self) -> None:
+        state = self.snapshot()
+        logger.info("Перемещено файлов: %d%s, %.1f МБ; %.1f файлов/с, %.1f МБ/с; осталось: %s",
+                    state["files_moved"], "" if self.files_total is None else f" из {self.files_total}",
+                    state["bytes_moved"] / MEGABYTE, state["files_per_second"], state["mb_per_second"],
+                    "неизвестно" if state["eta"] is None else f"{state['eta']:.0f} с")
+        self._emit({"event": "progress", **state})
+
+    def summary(self) -> None:
+        state = self.snapshot()
+        logger.info("Итого перемещено файлов: %d, кластеров: %d, %.1f МБ за %.3f с",
+                    state["files_moved"], state["clusters_moved"], state["bytes_moved"] / MEGABYTE, state["elapsed"])
+        self._emit({"event": "summary", **state, "phases": dict(self.phase_seconds)})
+
+    def _emit(self, event: dict) -> None:
+        if self.json_stream is None:
+            return
+        event["time"] = time.time()
+        self.json_stream.write(json.dumps(event, ensure_ascii=False) + "\n")
+        self.json_stream.flush()
+
+@contextlib.contextmanager
+def profiling(profile_path: Path | None = None, trace_memory: bool = False) -> Iterator[None]:
+    """
+    Необязательное профилирование блока: cProfile с сохранением статистики в profile_path
+    и tracemalloc с выводом пика памяти и самых затратных строк в журнал
+    """
+    profiler = cProfile.Profile() if profile_path is not None else None
+    if trace_memory:
+        tracemalloc.start()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+            logger.info("Профиль cProfile сохранён в %s", profile_path)
+        if trace_memory:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            logger.info("Пик памяти по tracemalloc: %.1f МБ", peak / MEGABYTE)
+            for statistic in snapshot.statistics("lineno")[:TRACEMALLOC_TOP_LINES]:
+                logger.info("  %s", statistic)
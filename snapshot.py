@@ -0,0 +1,193 @@
+import gzip
+import json
+import logging
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from bpb import BPB
+from directory_parser import CachedDirectory, DirectoryItem, DirectoryParser
+from fat_reader import FatReader
+from free_space import FreeExtent, chain_to_runs
+
+SNAPSHOT_VERSION = 2
+SNAPSHOT_COMPRESS_LEVEL = 1
+ITEM_FIELDS = ("path", "starting_cluster", "size", "entry_offset", "parent_cluster")
+
+logger = logging.getLogger(__name__)
+
+def volume_geometry(bpb: BPB) -> list[int]:
+    """
+    Параметры тома, при совпадении которых снимок вообще можно сравнивать с образом
+    """
+    return [bpb.byts_per_sec, bpb.sec_per_clus, bpb.reserved_sec_cnt, bpb.num_fats, bpb.fat_size_32,
+            bpb.total_sec_32]
+
+def _items_to_json(items: list[DirectoryItem]) -> list[list]:
+    return [[is_directory, *(record[name] for name in ITEM_FIELDS)] for is_directory, record in items]
+
+def _items_from_json(items: list[list]) -> list[DirectoryItem]:
+    return [(item[0], dict(zip(ITEM_FIELDS, item[1:]))) for item in items]
+
+@dataclass
+class VolumeSnapshot:
+    """
+    Компактный снимок тома после прогона: CRC32 каждого сектора FAT, разобранные каталоги
+    с цепочками и CRC32 содержимого и цепочки файлов каждого каталога в виде отрезков. При следующем
+    прогоне цепочки, записи FAT которых лежат только в неизменившихся секторах, не проходятся заново,
+    а каталоги с прежними цепочкой и содержимым не разбираются. После прогона снимок обновляется
+    только для каталогов и секторов, изменившихся с прошлого снимка или в этом прогоне.
+    """
+    geometry: list[int]
+    fat_checksums: list[int]
+    directories: dict[int, CachedDirectory] = field(default_factory=dict)
+    file_chains: dict[int, list[list[FreeExtent]]] = field(default_factory=dict)
+    stale_sectors: set[int] = field(default_factory=set)
+
+    @classmethod
+    def empty(cls, fat_reader: FatReader) -> "VolumeSnapshot":
+        """
+        Пустой снимок текущего тома: каталоги и цепочки заполнятся по ходу первого прогона
+        """
+        return cls(volume_geometry(fat_reader.bpb), fat_reader.sector_checksums())
+
+    def changed_sectors(self, fat_checksums: list[int]) -> set[int]:
+        """
+        Номера секторов FAT, CRC32 которых отличается от сохранённых
+        """
+        return {sector for sector, checksum in enumerate(fat_checksums)
+                if sector >= len(self.fat_checksums) or self.fat_checksums[sector] != checksum}
+
+    def known_chains(self, fat_reader: FatReader, changed_sectors: set[int]) -> dict[int, list[FreeExtent]]:
+        """
+        Цепочки файлов и каталогов по начальному кластеру, ни одна запись FAT которых не изменилась
+        """
+        chains = [runs for file_chains in self.file_chains.values() for runs in file_chains]
+        chains.extend(directory.runs for directory in self.directories.values())
+        return {runs[0][0]: runs for runs in chains
+                if runs and not fat_reader.chain_touches_sectors(runs, changed_sectors)}
+
+    def apply(self, fat_reader: FatReader, directory_parser: DirectoryParser) -> None:
+        """
+        Включает кэши цепочек и каталогов, заполняя их тем, что по снимку заведомо не изменилось.
+        Кэш каталогов - это сам словарь directories снимка, поэтому заново разобранные при обходе
+        каталоги сразу попадают в снимок.
+        """
+        fat_checksums = fat_reader.sector_checksums()
+        if self.geometry != volume_geometry(fat_reader.bpb):
+            logger.warning("Снимок снят с тома другой геометрии и не используется")
+            self.geometry = volume_geometry(fat_reader.bpb)
+            self.fat_checksums = fat_checksums
+            self.directories.clear()
+            self.file_chains.clear()
+        self.stale_sectors = self.changed_sectors(fat_checksums)
+        self.fat_checksums = fat_checksums
+        known_chains = self.known_chains(fat_reader, self.stale_sectors)
+        fat_reader.enable_chain_cache(known_chains)
+        directory_parser.directory_cache = self.directories
+        logger.info("Снимок: изменено секторов FAT %d из %d, неизменных цепочек %d, каталогов в снимке %d",
+                    len(self.stale_sectors), len(fat_checksums), len(known_chains), len(self.directories))
+
+    def refresh(self, fat_reader: FatReader, directory_parser: DirectoryParser, relocated: dict[int, int],
+                written_clusters: list[FreeExtent]) -> bool:
+        """
+        Приводит снимок к состоянию тома после прогона. FAT должна быть сброшена в образ, а дерево -
+        обойдено в этом прогоне. Каталоги, не встреченные при обходе, удаляются; каталоги, в кластеры
+        которых писали или чьи цепочки изменились, читаются заново (перенесённые - с нового места
+        из relocated). Цепочки файлов пересобираются для них, для каталогов, разобранных при обходе,
+        и для каталогов, цепочка хотя бы одного файла которых задевает изменённый сектор FAT.
+        CRC32 пересчитываются только для изменившихся секторов FAT. Возвращает False, если снимок
+        не изменился.
+        """
+        scanned = directory_parser.scanned_directories
+        removed = [cluster for cluster in self.directories if cluster not in scanned]
+        for cluster in removed:
+            del self.directories[cluster]
+            self.file_chains.pop(cluster, None)
+
+        changed_sectors = fat_reader.changed_sectors
+        dirty = self._written_directories(written_clusters)
+        if changed_sectors:
+            dirty.update(cluster for cluster, directory in self.directories.items()
+                         if fat_reader.chain_touches_sectors(directory.runs, changed_sectors))
+        paths = {relocated.get(cluster, cluster): self.directories.pop(cluster).path for cluster in dirty}
+        for cluster in dirty:
+            self.file_chains.pop(cluster, None)
+        for cluster, path in paths.items():
+            directory_parser.scan_directory(cluster, path)
+        rescanned = paths.keys()
+
+        sectors = self.stale_sectors | changed_sectors
+        recaptured = rescanned | (directory_parser.parsed_directories & self.directories.keys())
+        recaptured.update(cluster for cluster in self.directories if cluster not in self.file_chains)
+        if sectors:
+            recaptured.update(cluster for cluster, file_chains in self.file_chains.items()
+                              if any(fat_reader.chain_touches_sectors(runs, sectors) for runs in file_chains))
+        for cluster in recaptured:
+            self.file_chains[cluster] = [
+                fat_reader.cached_chain_runs(record["starting_cluster"])
+                or chain_to_runs(fat_reader.get_cluster_chain(record["starting_cluster"]))
+                for is_directory, record in self.directories[cluster].items if not is_directory
+            ]
+
+        for sector in sectors:
+            self.fat_checksums[sector] = fat_reader.sector_checksum(sector)
+        self.stale_sectors = set()
+        return bool(removed or dirty or recaptured or sectors)
+
+    def _written_directories(self, written_clusters: list[FreeExtent]) -> set[int]:
+        """
+        Каталоги снимка, хотя бы в один кластер которых писали
+        """
+        if not written_clusters:
+            return set()
+        owners = {cluster: owner for owner, directory in self.directories.items()
+                  for start, length in directory.runs for cluster in range(start, start + length)}
+        written: set[int] = set()
+        for first_cluster, clusters_count in written_clusters:
+            if clusters_count > len(owners):
+                written.update(owner for cluster, owner in owners.items()
+                               if first_cluster <= cluster < first_cluster + clusters_count)
+            else:
+                written.update(owners[cluster] for cluster in range(first_cluster, first_cluster + clusters_count)
+                               if cluster in owners)
+        return written
+
+    def save(self, snapshot_path: Path) -> None:
+        """
+        Сохраняет снимок в сжатый gzip JSON
+        """
+        snapshot = {
+            "version": SNAPSHOT_VERSION,
+            "geometry": self.geometry,
+            "fat_checksums": self.fat_checksums,
+            "directories": [
+                [cluster, directory.path, directory.runs, directory.checksum, _items_to_json(directory.items),
+                 self.file_chains.get(cluster, [])]
+                for cluster, directory in self.directories.items()
+            ],
+        }
+        data = json.dumps(snapshot, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        Path(snapshot_path).write_bytes(gzip.compress(data, SNAPSHOT_COMPRESS_LEVEL))
+
+    @classmethod
+    def load(cls, snapshot_path: Path) -> "VolumeSnapshot | None":
+        """
+        Загружает снимок; повреждённый снимок или снимок другой версии не используется
+        """
+        try:
+            snapshot = json.loads(gzip.decompress(Path(snapshot_path).read_bytes()))
+        except (OSError, EOFError, ValueError) as error:
+            logger.warning("Снимок %s не прочитан: %s", snapshot_path, error)
+            return None
+        if snapshot.get("version") != SNAPSHOT_VERSION:
+            logger.warning("Снимок %s другой версии и не используется", snapshot_path)
+            return None
+        return cls(
+            geometry=snapshot["geometry"],
+            fat_checksums=snapshot["fat_checksums"],
+            directories={
+                cluster: CachedDirectory(path, [tuple(run) for run in runs], checksum, _items_from_json(items))
+                for cluster, path, runs, checksum, items, _ in snapshot["directories"]
+            },
+            file_chains={cluster: file_chains for cluster, *_, file_chains in snapshot["directories"]},
+        )
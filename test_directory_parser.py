@@ -0,0 +1,38 @@
+from pathlib import Path
+
+import pytest
+
+from bpb import BPB
+from directory_parser import DirectoryParser
+from disk_image import DiskImage
+from fat_reader import FatReader
+from image_generator import ImageGenerator, ImageSpec
+
+SPEC = ImageSpec(volume_size=32 * 1024 * 1024, cluster_size=512, files=200, directories=40, seed=4)
+
+@pytest.fixture(scope="module")
+def cyclic_image(tmp_path_factory: pytest.TempPathFactory) -> Path:
+    """
+    Образ, в котором запись вложенного подкаталога указывает на его же родительский каталог
+    """
+    image_path = tmp_path_factory.mktemp("tree") / "cyclic.img"
+    ImageGenerator(SPEC).generate(image_path)
+    with DiskImage(image_path) as image:
+        fat_reader = FatReader(image, BPB(image))
+        directory_parser = DirectoryParser(fat_reader)
+        all_directories = directory_parser.get_tree(fat_reader.bpb.root_clus)[1]
+        nested = next(directory for directory in all_directories[1:]
+                      if directory["parent_cluster"] != fat_reader.bpb.root_clus)
+        directory_parser.write_starting_cluster(nested["entry_offset"], nested["parent_cluster"])
+    return image_path
+
+def test_tree_walks_agree_on_directory_cycle(cyclic_image: Path) -> None:
+    with DiskImage(cyclic_image, writable=False) as image:
+        fat_reader = FatReader(image, BPB(image))
+        root_cluster = fat_reader.bpb.root_clus
+        serial = [file["path"] for file in DirectoryParser(fat_reader).get_tree(root_cluster)[0]]
+        streamed = [file.path for file in DirectoryParser(fat_reader).iter_files(root_cluster)]
+
+    assert serial
+    assert len(serial) == len(set(serial))
+    assert serial == streamed
@@ -0,0 +1,107 @@
+import random
+from bisect import insort
+
+import pytest
+
+import free_space
+from free_space import ExtentsByAddress, FreeExtentIndex, SortedBlockList, group_runs
+
+VOLUME_CLUSTERS = 2000
+OPERATIONS = 3000
+
+@pytest.fixture(params=[1, 2, 3, 512])
+def block_size(request: pytest.FixtureRequest, monkeypatch: pytest.MonkeyPatch) -> int:
+    """
+    Прогоняет тест с разным размером блока: маленькие блоки постоянно делятся и удаляются
+    """
+    monkeypatch.setattr(free_space, "BLOCK_SIZE", request.param)
+    return request.param
+
+def test_sorted_block_list_matches_sorted_list(block_size: int) -> None:
+    rng = random.Random(block_size)
+    model: list[int] = []
+    keys = SortedBlockList()
+    for _ in range(OPERATIONS):
+        if model and rng.random() < 0.45:
+            key = rng.choice(model)
+            model.remove(key)
+            keys.remove(key)
+        else:
+            key = rng.randrange(1000)
+            insort(model, key)
+            keys.add(key)
+        probe = rng.randrange(-10, 1010)
+        assert keys.ceiling(probe) == next((key for key in model if key >= probe), None)
+        assert keys.floor(probe) == next((key for key in reversed(model) if key <= probe), None)
+        assert keys.first() == (model[0] if model else None)
+        assert keys.last() == (model[-1] if model else None)
+        assert len(keys) == len(model)
+    assert list(keys) == model
+    with pytest.raises(ValueError):
+        keys.remove(1000)
+
+def test_extents_by_address_fit_search(block_size: int) -> None:
+    rng = random.Random(block_size)
+    model: list[tuple[int, int]] = []
+    extents = ExtentsByAddress()
+    for _ in range(OPERATIONS):
+        if model and rng.random() < 0.45:
+            extent = rng.choice(model)
+            model.remove(extent)
+            extents.remove(extent)
+        else:
+            extent = (rng.randrange(100000), rng.randrange(1, 64))
+            if extent in model:
+                continue
+            insort(model, extent)
+            extents.add(extent)
+        clusters_count = rng.randrange(1, 70)
+        fitting = [extent for extent in model if extent[1] >= clusters_count]
+        assert extents.first_fit(clusters_count) == (fitting[0] if fitting else None)
+        assert extents.last_fit(clusters_count) == (fitting[-1] if fitting else None)
+
+def test_free_extent_index_matches_cluster_set(block_size: int) -> None:
+    rng = random.Random(block_size)
+    free_clusters = {cluster for cluster in range(VOLUME_CLUSTERS) if rng.random() < 0.5}
+    index = FreeExtentIndex(group_runs(sorted(free_clusters)))
+    for _ in range(OPERATIONS):
+        clusters_count = rng.randrange(1, 12)
+        if rng.random() < 0.5:
+            extent = index.find_best_fit(clusters_count) if rng.random() < 0.5 else index.find_last_fit(clusters_count)
+            if extent is None:
+                continue
+            start = extent[0] + rng.randrange(extent[1] - clusters_count + 1)
+            index.allocate(start, clusters_count)
+            free_clusters.difference_update(range(start, start + clusters_count))
+        else:
+            start = rng.randrange(VOLUME_CLUSTERS - clusters_count)
+            clusters = range(start, start + clusters_count)
+            if free_clusters.intersection(clusters):
+                with pytest.raises(ValueError):
+                    index.free(start, clusters_count)
+                continue
+            index.free(start, clusters_count)
+            free_clusters.update(clusters)
+
+        runs = group_runs(sorted(free_clusters))
+        assert list(index._by_address) == runs
+        assert index.free_clusters_count == len(free_clusters)
+        assert index.first_free() == (runs[0][0] if runs else None)
+        probe = rng.randrange(1, 16)
+        fitting = [run for run in runs if run[1] >= probe]
+        assert index.find_best_fit(probe) == min(fitting, key=lambda run: (run[1], run[0]), default=None)
+        assert index.find_last_fit(probe) == (fitting[-1] if fitting else None)
+
+def test_allocate_and_free_reject_wrong_state() -> None:
+    index = FreeExtentIndex([(10, 5), (20, 5)])
+    with pytest.raises(ValueError):
+        index.allocate(15, 1)
+    with pytest.raises(ValueError):
+        index.allocate(12, 5)
+    with pytest.raises(ValueError):
+        index.free(14, 2)
+    with pytest.raises(ValueError):
+        index.free(16, 10)
+    assert index.free_clusters_count == 10
+    index.free(15, 5)
+    assert list(index._by_address) == [(10, 15)]
@@ -0,0 +1,126 @@
+import shutil
+from pathlib import Path
+
+import pytest
+
+from bpb import BPB
+from defragmenter import Defragmenter
+from directory_parser import DirectoryParser
+from disk_image import DiskImage
+from fat_reader import MIN_VALID_INDEX, FatReader
+from image_generator import ImageGenerator, ImageSpec, find_corrupted_files
+from journal import RelocationJournal
+
+SPEC = ImageSpec(volume_size=32 * 1024 * 1024, cluster_size=512, files=120, directories=12,
+                 max_file_clusters=16, seed=1)
+CRASH_POINTS = ("begin", "copied", "commit")
+FILE_MOVE_NUMBER = 3
+
+class SimulatedCrash(Exception):
+    pass
+
+class CrashingJournal(RelocationJournal):
+    """
+    Журнал, который обрывает выполнение на заданном шаге перемещения выбранного объекта,
+    как kill -9: всё записанное в образ до этого момента остаётся, несброшенная FAT теряется
+    """
+    def __init__(self, journal_path: Path, target: str, crash_point: str) -> None:
+        super().__init__(journal_path)
+        self.target = target
+        self.crash_point = crash_point
+        self._file_moves = 0
+        self._active = False
+
+    def begin(self, path: str, entry_offset: int | None, old_chain: list[int], new_chain: list[int],
+              old_chain_end: int, is_directory: bool = False) -> None:
+        super().begin(path, entry_offset, old_chain, new_chain, old_chain_end, is_directory)
+        if not is_directory:
+            self._file_moves += 1
+        if self.target == "file":
+            self._active = not is_directory and self._file_moves == FILE_MOVE_NUMBER
+        elif self.target == "directory":
+            self._active = is_directory and entry_offset is not None
+        else:
+            self._active = is_directory and entry_offset is None
+        if self._active and self.crash_point == "begin":
+            raise SimulatedCrash(path)
+
+    def mark_copied(self) -> None:
+        super().mark_copied()
+        if self._active and self.crash_point == "copied":
+            raise SimulatedCrash(self._record["path"])
+
+    def commit(self) -> None:
+        if self._active and self.crash_point == "commit":
+            raise SimulatedCrash(self._record["path"])
+        super().commit()
+
+@pytest.fixture(scope="module")
+def generated_image(tmp_path_factory: pytest.TempPathFactory) -> Path:
+    image_path = tmp_path_factory.mktemp("recovery") / "source.img"
+    ImageGenerator(SPEC).generate(image_path)
+    return image_path
+
+def list_files(directory_parser: DirectoryParser) -> list[tuple[str, int]]:
+    all_files = directory_parser.get_all_files(directory_parser.fat_reader.bpb.root_clus)
+    return sorted((file["path"], file["size"]) for file in all_files)
+
+def check_volume(image: DiskImage, expected_files: list[tuple[str, int]]) -> None:
+    """
+    Проверяет, что содержимое файлов, записи '.' и '..', копии FAT и занятость кластеров согласованы
+    """
+    fat_reader = FatReader(image, BPB(image))
+    directory_parser = DirectoryParser(fat_reader)
+    assert find_corrupted_files(fat_reader, directory_parser) == []
+    assert list_files(directory_parser) == expected_files
+
+    fat_size = fat_reader.bpb.fat_size_32 * fat_reader.bpb.byts_per_sec
+    fat_copies = {bytes(image.read(fat_reader.get_fat_offset(fat_number), fat_size))
+                  for fat_number in fat_reader.bpb.active_fats()}
+    assert len(fat_copies) == 1
+
+    all_files, all_directories = directory_parser.get_tree(fat_reader.bpb.root_clus)
+    used_clusters: list[int] = []
+    for record in all_files + all_directories:
+        if record["starting_cluster"] >= MIN_VALID_INDEX:
+            used_clusters.extend(fat_reader.get_cluster_chain(record["starting_cluster"]))
+    assert len(used_clusters) == len(set(used_clusters)), "кластер принадлежит двум цепочкам"
+    allocated = {cluster for cluster in range(MIN_VALID_INDEX, fat_reader.total_clusters)
+                 if not fat_reader.is_free(cluster)}
+    assert allocated == set(used_clusters), "занятые кластеры не принадлежат ни одной цепочке"
+
+    root_cluster = fat_reader.bpb.root_clus
+    for directory in all_directories[1:]:
+        dot_offset = fat_reader.get_cluster_offset(directory["starting_cluster"])
+        parent_cluster = 0 if directory["parent_cluster"] == root_cluster else directory["parent_cluster"]
+        assert bytes(image.read(dot_offset, 2)) == b". "
+        assert directory_parser.read_starting_cluster(dot_offset) == directory["starting_cluster"]
+        assert bytes(image.read(dot_offset + 32, 2)) == b".."
+        assert directory_parser.read_starting_cluster(dot_offset + 32) == parent_cluster
+
+@pytest.mark.parametrize("target", ["file", "directory", "root"])
+@pytest.mark.parametrize("crash_point", CRASH_POINTS)
+def test_interrupted_move_is_recovered(generated_image: Path, tmp_path: Path, target: str, crash_point: str) -> None:
+    image_path = tmp_path / "volume.img"
+    journal_path = tmp_path / "volume.img.journal"
+    shutil.copyfile(generated_image, image_path)
+    with DiskImage(image_path, writable=False) as image:
+        expected_files = list_files(DirectoryParser(FatReader(image, BPB(image))))
+
+    with DiskImage(image_path) as image:
+        fat_reader = FatReader(image, BPB(image))
+        journal = CrashingJournal(journal_path, target, crash_point)
+        defragmenter = Defragmenter(image, fat_reader, DirectoryParser(fat_reader), journal=journal)
+        with pytest.raises(SimulatedCrash):
+            defragmenter.defragment()
+    assert journal_path.exists()
+
+    with DiskImage(image_path) as image:
+        fat_reader = FatReader(image, BPB(image))
+        defragmenter = Defragmenter(image, fat_reader, DirectoryParser(fat_reader),
+                                    journal=RelocationJournal(journal_path))
+        assert not journal_path.exists()
+        check_volume(image, expected_files)
+
+        defragmenter.defragment()
+        check_volume(image, expected_files)
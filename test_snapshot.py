@@ -0,0 +1,66 @@
+import shutil
+from pathlib import Path
+
+import pytest
+
+from bpb import BPB
+from defragmenter import Defragmenter
+from directory_parser import DirectoryParser
+from disk_image import DiskImage
+from fat_reader import FatReader
+from free_space import chain_to_runs
+from image_generator import ImageGenerator, ImageSpec
+from planner import PLACEMENT_BEST_FIT, PLACEMENT_LOCALITY
+from snapshot import VolumeSnapshot
+
+SPEC = ImageSpec(volume_size=32 * 1024 * 1024, cluster_size=512, files=200, directories=30, seed=3)
+
+@pytest.fixture(scope="module")
+def generated_image(tmp_path_factory: pytest.TempPathFactory) -> Path:
+    image_path = tmp_path_factory.mktemp("snapshot") / "source.img"
+    ImageGenerator(SPEC).generate(image_path)
+    return image_path
+
+def defragment(image_path: Path, snapshot_path: Path, placement: str) -> None:
+    with DiskImage(image_path) as image:
+        fat_reader = FatReader(image, BPB(image))
+        Defragmenter(image, fat_reader, DirectoryParser(fat_reader), placement=placement,
+                     snapshot_path=snapshot_path).defragment()
+
+def check_snapshot(image_path: Path, snapshot_path: Path) -> None:
+    """
+    Сверяет сохранённый снимок с тем, что даёт полный разбор тома без снимка
+    """
+    snapshot = VolumeSnapshot.load(snapshot_path)
+    with DiskImage(image_path, writable=False) as image:
+        fat_reader = FatReader(image, BPB(image))
+        directory_parser = DirectoryParser(fat_reader)
+        directory_parser.directory_cache = {}
+        directory_parser.get_tree(fat_reader.bpb.root_clus)
+        assert snapshot.fat_checksums == fat_reader.sector_checksums()
+        assert snapshot.directories == directory_parser.directory_cache
+        for cluster, directory in directory_parser.directory_cache.items():
+            file_chains = [chain_to_runs(fat_reader.get_cluster_chain(record["starting_cluster"]))
+                           for is_directory, record in directory.items if not is_directory]
+            assert [[tuple(run) for run in runs] for runs in snapshot.file_chains[cluster]] == file_chains
+
+@pytest.mark.parametrize("placement", [PLACEMENT_BEST_FIT, PLACEMENT_LOCALITY])
+def test_snapshot_follows_moves_and_is_kept_when_unchanged(generated_image: Path, tmp_path: Path,
+                                                           placement: str) -> None:
+    image_path = tmp_path / "volume.img"
+    snapshot_path = tmp_path / "volume.snapshot"
+    shutil.copyfile(generated_image, image_path)
+
+    defragment(image_path, snapshot_path, placement)
+    check_snapshot(image_path, snapshot_path)
+
+    saved = snapshot_path.read_bytes()
+    snapshot_path.touch()
+    mtime = snapshot_path.stat().st_mtime_ns
+    defragment(image_path, snapshot_path, placement)
+    assert snapshot_path.stat().st_mtime_ns == mtime
+    assert snapshot_path.read_bytes() == saved
+
+    shutil.copyfile(generated_image, image_path)
+    defragment(image_path, snapshot_path, placement)
+    check_snapshot(image_path, snapshot_path)